@@ -0,0 +1,41 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# Measures the time needed to parse the PhET metadata document and build the
+# all_links catalog from it (the part of retrieve_all_links after the download).
+#
+#   $ python benchmarks/bench_catalog_build.py [iterations]
+#
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import g4l_rlms_phet
+
+from fixtures import load_metadata_text
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    metadata_text = load_metadata_text()
+
+    parse_time = 0
+    build_time = 0
+    for _ in range(iterations):
+        t0 = time.time()
+        contents = json.loads(metadata_text)
+        t1 = time.time()
+        all_links, _ = g4l_rlms_phet._build_all_links(contents)
+        t2 = time.time()
+        parse_time += t1 - t0
+        build_time += t2 - t1
+
+    print "%s bytes, %s projects, %s laboratories" % (len(metadata_text), len(contents['projects']), len(all_links))
+    print "parse: %.2f ms" % (1e3 * parse_time / iterations)
+    print "build: %.2f ms" % (1e3 * build_time / iterations)
+
+if __name__ == '__main__':
+    main()
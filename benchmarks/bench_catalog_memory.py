@@ -0,0 +1,56 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# Compares the memory used by the catalog (PhETCatalog) with the nested dicts
+# all_links used to be (PhETCatalog.to_dict()), both in memory and pickled
+# (as stored in the LabManager cache).
+#
+#   $ python benchmarks/bench_catalog_memory.py
+#
+
+import os
+import sys
+import json
+import cPickle as pickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import g4l_rlms_phet
+
+from fixtures import load_metadata_text
+
+def deep_size(obj, seen = None):
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += deep_size(value, seen)
+    elif hasattr(obj, '__slots__'):
+        for name in obj.__slots__:
+            size += deep_size(getattr(obj, name, None), seen)
+    return size
+
+def main():
+    contents = json.loads(load_metadata_text())
+    catalog, _ = g4l_rlms_phet._build_all_links(contents)
+    legacy = catalog.to_dict()
+
+    legacy_memory = deep_size(legacy)
+    catalog_memory = deep_size(catalog)
+    legacy_pickled = len(pickle.dumps(legacy, pickle.HIGHEST_PROTOCOL))
+    catalog_pickled = len(pickle.dumps(catalog, pickle.HIGHEST_PROTOCOL))
+
+    print "%s laboratories" % len(catalog)
+    print "in memory: %8.1f KB -> %8.1f KB (%.0f%% less)" % (legacy_memory / 1024.0, catalog_memory / 1024.0, 100.0 - 100.0 * catalog_memory / legacy_memory)
+    print "pickled:   %8.1f KB -> %8.1f KB (%.0f%% less)" % (legacy_pickled / 1024.0, catalog_pickled / 1024.0, 100.0 - 100.0 * catalog_pickled / legacy_pickled)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# Compares the former per-string RLMS._convert_i18n_strings with the batched
+# conversion (namespace index shared by all the languages), on a multi-locale
+# string map.
+#
+#   $ python benchmarks/bench_i18n_convert.py [iterations]
+#
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import g4l_rlms_phet
+
+from fixtures import load_string_map_text
+
+def legacy_convert_i18n_strings(strings):
+    translations = {}
+    for lang in strings.keys():
+        translations[lang] = {}
+        for key, value in strings[lang].items():
+            if '/' in key:
+                namespace, _ = key.split('/', 1)
+            else:
+                namespace = None
+            translations[lang][key] = {
+                'value': value,
+            }
+
+            if namespace is not None:
+                translations[lang][key]['namespace'] = namespace
+
+    return translations
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    string_map_text = load_string_map_text()
+    strings = json.loads(string_map_text)
+    rlms = g4l_rlms_phet.RLMS("{}")
+
+    t0 = time.time()
+    for _ in range(iterations):
+        legacy = legacy_convert_i18n_strings(strings)
+    legacy_time = time.time() - t0
+
+    t0 = time.time()
+    for _ in range(iterations):
+        batched = rlms._convert_i18n_strings(strings)
+    batched_time = time.time() - t0
+
+    assert legacy == batched, "The batched conversion does not match the previous implementation"
+
+    t0 = time.time()
+    for _ in range(iterations):
+        streamed = 0
+        for lang, converted in rlms._iter_converted_i18n_strings(json.loads(string_map_text), consume = True):
+            streamed += len(converted)
+    streamed_time = time.time() - t0
+
+    print "%s languages, %s strings" % (len(strings), sum([ len(lang_strings) for lang_strings in strings.values() ]))
+    print "per string:        %.2f ms" % (1e3 * legacy_time / iterations)
+    print "batched:           %.2f ms" % (1e3 * batched_time / iterations)
+    print "streamed (+parse): %.2f ms" % (1e3 * streamed_time / iterations)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# Measures the time needed to import g4l_rlms_phet in a new interpreter (as
+# every LabManager worker and CLI invocation does), and which of the heavy
+# dependencies get imported with it. The results are printed as JSON.
+#
+#   $ python benchmarks/bench_import_time.py [iterations]
+#
+
+import os
+import sys
+import json
+import subprocess
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+HEAVY_MODULES = [ 'requests', 'bs4', 'flask', 'wtforms', 'labmanager.forms', 'ijson' ]
+
+IMPORT_SCRIPT = """
+import sys, time, json
+baseline = set(sys.modules)
+t0 = time.time()
+import g4l_rlms_phet
+elapsed = time.time() - t0
+print json.dumps({
+    'import_ms': 1e3 * elapsed,
+    'new_modules': len(set(sys.modules) - baseline),
+    'heavy_modules': [ name for name in %r if sys.modules.get(name) is not None ],
+})
+""" % (HEAVY_MODULES,)
+
+def measure_import():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ PACKAGE_DIR ] + ([ env['PYTHONPATH'] ] if env.get('PYTHONPATH') else []))
+    output = subprocess.check_output([ sys.executable, '-c', IMPORT_SCRIPT ], env = env)
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    runs = [ measure_import() for _ in range(iterations) ]
+    import_times = sorted([ run['import_ms'] for run in runs ])
+    print json.dumps({
+        'python': sys.version.split()[0],
+        'iterations': iterations,
+        'import_ms': {
+            'mean': sum(import_times) / len(import_times),
+            'min': import_times[0],
+            'median': import_times[len(import_times) / 2],
+            'max': import_times[-1],
+        },
+        'new_modules': runs[-1]['new_modules'],
+        'heavy_modules': runs[-1]['heavy_modules'],
+    }, indent = 4, sort_keys = True)
+
+if __name__ == '__main__':
+    main()
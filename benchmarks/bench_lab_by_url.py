@@ -0,0 +1,83 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# Compares get_lab_by_url as it used to be (rebuilding a {slug: lab} dict on
+# every call) against the precomputed URL index.
+#
+#   $ python benchmarks/bench_lab_by_url.py [number of labs] [iterations]
+#
+
+import os
+import sys
+import time
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from labmanager.rlms import Laboratory
+
+import g4l_rlms_phet
+
+URLS = [
+    "https://phet.colorado.edu/en/simulation/sim-%s",
+    "https://phet.colorado.edu/sims/html/sim-%s/latest/sim-%s_en.html",
+    "https://phet.colorado.edu/en/simulation/legacy/sim-%s",
+    "https://phet.colorado.edu/sims/sim-%s/sim-%s_en.html",
+    "https://phet.colorado.edu/sims/project/sim-%s_en.jnlp",
+    "https://phet.colorado.edu/en/simulation/not-found",
+]
+
+def legacy_get_lab_by_url(laboratories, url):
+    labs = { lab.laboratory_id.rsplit('/', 1)[-1]: lab for lab in laboratories }
+    path = urlparse.urlparse(url).path
+    parts = path[1:].split('/')
+    if len(parts) > 2:
+        if parts[1] == 'simulation':
+            if parts[2] == 'legacy' and len(parts) > 3:
+                if parts[3] in labs.keys():
+                    return labs[parts[3]]
+            if parts[2] in labs.keys():
+                return labs[parts[2]]
+        if parts[1] == 'html' and parts[2] in labs.keys():
+            return labs[parts[2]]
+        if parts[0] == 'sims':
+            if parts[1] in labs.keys():
+                return labs[parts[1]]
+            if parts[2].split('_')[0] in labs.keys():
+                return labs[parts[2].split('_')[0]]
+
+    return None
+
+def build_urls(number_of_labs, iterations):
+    urls = []
+    for pos in range(iterations):
+        template = URLS[pos % len(URLS)]
+        urls.append(template.replace('%s', str(pos % number_of_labs)))
+    return urls
+
+def main():
+    number_of_labs = int(sys.argv[1]) if len(sys.argv) > 1 else 150
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+    laboratories = [ Laboratory(name = 'Sim %s' % pos, laboratory_id = 'http://phet.colorado.edu/en/simulation/sim-%s' % pos, autoload = True) for pos in range(number_of_labs) ]
+    urls = build_urls(number_of_labs, iterations)
+
+    t0 = time.time()
+    legacy_results = [ legacy_get_lab_by_url(laboratories, url) for url in urls ]
+    legacy_time = time.time() - t0
+
+    t0 = time.time()
+    index = g4l_rlms_phet.build_lab_url_index(laboratories)
+    build_time = time.time() - t0
+
+    t0 = time.time()
+    indexed_results = [ g4l_rlms_phet.find_lab_in_url_index(index, url) for url in urls ]
+    indexed_time = time.time() - t0
+
+    assert legacy_results == indexed_results, "The URL index does not match the previous implementation"
+
+    print "%s labs, %s lookups" % (number_of_labs, iterations)
+    print "rebuilding dict per call: %.2f us/lookup" % (1e6 * legacy_time / iterations)
+    print "precomputed index:        %.2f us/lookup (index built once in %.2f ms)" % (1e6 * indexed_time / iterations, 1e3 * build_time)
+
+if __name__ == '__main__':
+    main()
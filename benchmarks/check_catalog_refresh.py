@@ -0,0 +1,104 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# Checks that readers running while the catalog is refreshed do not keep
+# serving the previous catalog. The refresh runs as it does once get_links
+# expires (in the background, while the previous catalog is still published),
+# and get_laboratories() and get_lab_by_url() are called from another thread
+# right after the new catalog is built, and right before and after the
+# changed laboratories are invalidated. Once the refresh finishes, both must
+# return the new names.
+#
+#   $ python benchmarks/check_catalog_refresh.py
+#
+# Exits with status 1 if any check fails.
+#
+
+import sys
+import json
+import threading
+
+from run_benchmarks import g4l_rlms_phet, RedirectingHttpClient, reset_caches
+from stub_server import FixtureServer
+from fixtures import load_metadata_text
+
+RENAMED_SUFFIX = ' (renamed)'
+
+def check(description, condition):
+    print("%s: %s" % ('ok' if condition else 'FAILED', description))
+    return condition
+
+def rename_first_project(metadata_text):
+    metadata = json.loads(metadata_text)
+    for simulation in metadata['projects'][0]['simulations']:
+        for localized in simulation['localizedSimulations']:
+            localized['title'] = localized['title'] + RENAMED_SUFFIX
+    return json.dumps(metadata)
+
+class Reader(object):
+    # Calls the readers from another thread, as a concurrent request would
+    def __init__(self, rlms, url):
+        self.rlms = rlms
+        self.url = url
+        self.calls = 0
+
+    def read(self):
+        def run():
+            self.rlms.get_laboratories()
+            self.rlms.get_lab_by_url(self.url)
+            self.calls += 1
+        thread = threading.Thread(target = run, name = 'Reader')
+        thread.start()
+        thread.join()
+
+def wrap(name, before = None, after = None):
+    original = getattr(g4l_rlms_phet, name)
+    def wrapper(*args, **kwargs):
+        if before is not None:
+            before()
+        result = original(*args, **kwargs)
+        if after is not None:
+            after()
+        return result
+    setattr(g4l_rlms_phet, name, wrapper)
+
+def main():
+    server = FixtureServer()
+    server.start()
+    g4l_rlms_phet.HTTP = RedirectingHttpClient(server.base_url)
+    reset_caches()
+
+    rlms = g4l_rlms_phet.RLMS("{}")
+    laboratory_ids = set([ lab.laboratory_id for lab in rlms.get_laboratories() ])
+    previous_names = dict([ (lab.laboratory_id, lab.name) for lab in rlms.get_laboratories() ])
+
+    server.set_document('metadata', rename_first_project(load_metadata_text()))
+    renamed = [ link for link, entry in g4l_rlms_phet._build_all_links(json.loads(server.documents['metadata'][0]))[0].iteritems()
+                if link in laboratory_ids and entry.name('en_ALL').endswith(RENAMED_SUFFIX) ]
+    if not check("the fixture renames %s laboratories" % len(renamed), renamed):
+        sys.exit(1)
+
+    laboratory_id = renamed[0]
+    reader = Reader(rlms, laboratory_id)
+    wrap('_fetch_all_links', after = reader.read)
+    wrap('_invalidate_changed_links', before = reader.read, after = reader.read)
+
+    # What the background rebuild of get_links does (see _TwoTierCache._compute)
+    g4l_rlms_phet.CACHE.set('get_links', g4l_rlms_phet._download_all_links())
+
+    passed = True
+    passed &= check("readers ran %s times during the refresh" % reader.calls, reader.calls == 3)
+
+    catalog_name = g4l_rlms_phet.retrieve_all_links()[laboratory_id].name('en_ALL')
+    passed &= check("the published catalog has the new name", catalog_name == previous_names[laboratory_id] + RENAMED_SUFFIX)
+
+    names = dict([ (lab.laboratory_id, lab.name) for lab in rlms.get_laboratories() ])
+    passed &= check("get_laboratories has the new name", names[laboratory_id] == catalog_name)
+
+    lab = rlms.get_lab_by_url(laboratory_id)
+    passed &= check("get_lab_by_url has the new name", lab is not None and lab.name == catalog_name)
+
+    server.shutdown()
+    sys.exit(0 if passed else 1)
+
+if __name__ == '__main__':
+    main()
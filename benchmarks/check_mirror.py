@@ -0,0 +1,108 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# Checks the downloads of the simulation mirror (see _SimMirror) against the
+# local stub server (see stub_server.py), in a temporary directory:
+#
+#   - download: a simulation is downloaded and stored by its digest
+#   - revalidation: downloading it again gets a 304 and nothing is downloaded
+#   - resume: a truncated download left in partial/ is resumed with a Range
+#     request (206), and only the rest of the file is downloaded
+#   - restart: a complete download left in partial/ gets a 416, and the file
+#     is downloaded again from the beginning
+#   - changed: a truncated download of a previous version (another ETag) is
+#     discarded, and the file is downloaded again from the beginning
+#
+#   $ python benchmarks/check_mirror.py
+#
+# Exits with status 1 if any check fails.
+#
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+
+from run_benchmarks import g4l_rlms_phet, RedirectingHttpClient
+from stub_server import FixtureServer
+
+SIM_URL = 'https://phet.colorado.edu/sims/html/sim-0/latest/sim-0_es.html?download'
+
+class RecordingHttpClient(RedirectingHttpClient):
+    # Keeps the status code of every response
+    def __init__(self, base_url):
+        RedirectingHttpClient.__init__(self, base_url)
+        self.statuses = []
+
+    def request(self, method, url, **kwargs):
+        r = RedirectingHttpClient.request(self, method, url, **kwargs)
+        self.statuses.append(r.status_code)
+        return r
+
+def check(description, condition):
+    print("%s: %s" % ('ok' if condition else 'FAILED', description))
+    return condition
+
+def leave_part(mirror, contents, etag):
+    # What a process killed while downloading SIM_URL leaves behind
+    url_hash = hashlib.sha1(g4l_rlms_phet._mirror_key(SIM_URL)).hexdigest()
+    if not os.path.exists(mirror.partial_dir):
+        os.makedirs(mirror.partial_dir)
+    with open(os.path.join(mirror.partial_dir, url_hash + '.part'), 'wb') as f:
+        f.write(contents)
+    with open(os.path.join(mirror.partial_dir, url_hash + '.json'), 'w') as f:
+        json.dump({ 'etag': etag, 'last_modified': None }, f)
+
+def stored(mirror, result, body):
+    # The entry points to a file with the whole body, and nothing is left in partial/
+    if result.get('digest') != hashlib.sha256(body).hexdigest():
+        return False
+    with open(mirror.object_path(result['digest']), 'rb') as f:
+        if f.read() != body:
+            return False
+    return not os.listdir(mirror.partial_dir)
+
+def main():
+    server = FixtureServer()
+    server.start()
+    http = RecordingHttpClient(server.base_url)
+    g4l_rlms_phet.HTTP = http
+    root = tempfile.mkdtemp(prefix = 'g4l_phet_mirror_')
+    mirror = g4l_rlms_phet._SimMirror(root)
+    body, etag = server.documents['sim_html']
+    passed = True
+
+    try:
+        result = mirror.fetch(SIM_URL)
+        passed &= check("download: %s bytes downloaded and stored" % result['downloaded'],
+                        result['status'] == 200 and result['downloaded'] == len(body) and stored(mirror, result, body))
+
+        result = mirror.fetch(SIM_URL)
+        passed &= check("revalidation: 304 and nothing downloaded", result['status'] == 304 and result['downloaded'] == 0)
+
+        truncated = len(body) // 3
+        leave_part(mirror, body[:truncated], etag)
+        result = mirror.fetch(SIM_URL, force = True)
+        passed &= check("resume: 206 and only the last %s of %s bytes downloaded" % (result['downloaded'], len(body)),
+                        result['status'] == 206 and result['downloaded'] == len(body) - truncated and stored(mirror, result, body))
+
+        leave_part(mirror, body, etag)
+        del http.statuses[:]
+        result = mirror.fetch(SIM_URL, force = True)
+        passed &= check("restart: responses %s, and the whole file downloaded again" % http.statuses,
+                        http.statuses == [ 416, 200 ] and result['downloaded'] == len(body) and stored(mirror, result, body))
+
+        leave_part(mirror, 'previous version', '"previous"')
+        result = mirror.fetch(SIM_URL, force = True)
+        passed &= check("changed: 200 and the whole file downloaded again",
+                        result['status'] == 200 and result['downloaded'] == len(body) and stored(mirror, result, body))
+    finally:
+        http.session.close()
+        shutil.rmtree(root)
+        server.shutdown()
+
+    sys.exit(0 if passed else 1)
+
+if __name__ == '__main__':
+    main()
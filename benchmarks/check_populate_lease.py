@@ -0,0 +1,119 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# Checks the populate_cache lease with several local processes ("nodes")
+# sharing an in-memory stand-in of the LabManager cache (a dict of a
+# multiprocessing.Manager), against the local stub server (see stub_server.py):
+#
+#   - election: every node runs populate_cache at once, and exactly one of
+#     them populates the cache
+#   - follower skip: when they run it again right after, every node skips it
+#   - takeover: the leader dies while populating the cache, and a follower
+#     populates it as soon as the lease expires
+#
+#   $ python benchmarks/check_populate_lease.py [--nodes N]
+#
+# Exits with status 1 if any check fails.
+#
+
+import os
+import sys
+import time
+import datetime
+import argparse
+import multiprocessing
+
+from run_benchmarks import g4l_rlms_phet, RedirectingHttpClient
+from stub_server import FixtureServer
+
+LEASE_TTL = 2
+SETTLE_TIME = 0.2
+
+class SharedCache(object):
+    # Same interface as PHET.cache, on a dict shared by the processes. Nothing expires.
+    def __init__(self, shared):
+        self.shared = shared
+
+    def get(self, key, default = None, min_time = None):
+        return self.shared.get(key, default)
+
+    def __setitem__(self, key, value):
+        self.shared[key] = value
+
+    def set_many(self, values):
+        self.shared.update(values)
+
+def run_node(name, shared, base_url, results, die = False, wait_for_leader = False):
+    g4l_rlms_phet.CACHE.shared = SharedCache(shared)
+    g4l_rlms_phet.HTTP = RedirectingHttpClient(base_url)
+    g4l_rlms_phet.POPULATE_LEASE_TTL = datetime.timedelta(seconds = LEASE_TTL)
+    g4l_rlms_phet._Lease.SETTLE_TIME = SETTLE_TIME
+
+    if die:
+        def populate_and_die(lease = None):
+            os._exit(1)
+        g4l_rlms_phet._populate_cache_bulk = populate_and_die
+
+    results.append((name, g4l_rlms_phet._process_id(), g4l_rlms_phet.populate_cache()))
+
+    watcher = g4l_rlms_phet._LEADER_WATCHER
+    if wait_for_leader and watcher is not None:
+        watcher.join(10 * LEASE_TTL)
+
+def run_nodes(names, shared, base_url, results, **kwargs):
+    nodes = [ multiprocessing.Process(target = run_node, args = (name, shared, base_url, results), kwargs = kwargs) for name in names ]
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        node.join()
+    return nodes
+
+def check(description, condition):
+    print("%s: %s" % ('ok' if condition else 'FAILED', description))
+    return condition
+
+def count_responses(shared):
+    return len([ key for key, value in shared.items() if key.startswith('http') and value is not None ])
+
+def main():
+    parser = argparse.ArgumentParser(description = "Checks the populate_cache lease with several local processes")
+    parser.add_argument('--nodes', type = int, default = 5)
+    args = parser.parse_args()
+
+    server = FixtureServer()
+    server.start()
+    manager = multiprocessing.Manager()
+    shared = manager.dict()
+    results = manager.list()
+    passed = True
+
+    names = [ 'node-%s' % number for number in range(args.nodes) ]
+    run_nodes(names, shared, server.base_url, results)
+    winners = [ name for name, _, populated in results if populated ]
+    passed &= check("election: %s of %s nodes populated the cache" % (len(winners), len(names)), len(winners) == 1)
+    passed &= check("election: the catalog and %s responses stored" % count_responses(shared), shared.get('get_links') is not None and count_responses(shared) > 0)
+    passed &= check("election: the lease was released", shared.get('populate_cache_lease') is None)
+
+    del results[:]
+    run_nodes(names, shared, server.base_url, results)
+    passed &= check("follower skip: no node populated the cache again", not [ name for name, _, populated in results if populated ])
+
+    shared.clear()
+    del results[:]
+    run_nodes([ 'leader' ], shared, server.base_url, results, die = True)
+    lease = shared.get('populate_cache_lease')
+    passed &= check("takeover: the dead leader left its lease behind", lease is not None and shared.get('populate_cache_last') is None)
+
+    t0 = time.time()
+    run_nodes([ 'follower' ], shared, server.base_url, results, wait_for_leader = True)
+    last = shared.get('populate_cache_last')
+    follower_ids = [ process_id for name, process_id, _ in results if name == 'follower' ]
+    passed &= check("takeover: the follower skipped it while the lease was alive", [ populated for name, _, populated in results if name == 'follower' ] == [ False ])
+    passed &= check("takeover: the follower populated the cache %.1f seconds later (lease TTL: %s seconds)" % (time.time() - t0, LEASE_TTL),
+                    last is not None and last['owner'] in follower_ids and count_responses(shared) > 0)
+
+    manager.shutdown()
+    server.shutdown()
+    sys.exit(0 if passed else 1)
+
+if __name__ == '__main__':
+    main()
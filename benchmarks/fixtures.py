@@ -0,0 +1,165 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# Fixtures for the benchmarks.
+#
+# A real metadata document, a real string map and a real simulation HTML can
+# be recorded with:
+#
+#   $ python benchmarks/fixtures.py record
+#
+# which stores them in benchmarks/fixtures/. If there is no recorded
+# document, a synthetic one with the same structure (and a similar size:
+# ~150 projects, ~30 locales) is generated instead, so the benchmarks also
+# run offline.
+#
+
+import os
+import sys
+import json
+import random
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+METADATA_FIXTURE = os.path.join(FIXTURES_DIR, 'simulations.json')
+STRING_MAP_FIXTURE = os.path.join(FIXTURES_DIR, 'string-map.json')
+SIM_HTML_FIXTURE = os.path.join(FIXTURES_DIR, 'simulation.html')
+
+METADATA_URL = "https://phet.colorado.edu/services/metadata/1.0/simulations?format=json"
+STRING_MAP_URL = "https://phet.colorado.edu/sims/html/acid-base-solutions/latest/acid-base-solutions_string-map.json"
+SIM_HTML_URL = "https://phet.colorado.edu/sims/html/acid-base-solutions/latest/acid-base-solutions_en.html"
+
+LOCALES = [ 'ar', 'bg', 'ca', 'cs', 'da', 'de', 'el', 'es', 'es_MX', 'es_PE', 'eu', 'fa', 'fi',
+            'fr', 'gl', 'hu', 'it', 'ja', 'ko', 'lt', 'nl', 'pl', 'pt', 'pt_BR', 'ro', 'ru',
+            'sk', 'sl', 'sr', 'sr_Latn', 'sv', 'th', 'tr', 'uk', 'vi', 'zh_CN', 'zh_TW' ]
+
+DOMAINS = [ 'physics', 'motion', 'sound-and-waves', 'work-energy-and-power', 'heat-and-thermo',
+            'quantum-phenomena', 'light-and-radiation', 'electricity-magnets-and-circuits',
+            'biology', 'chemistry', 'general-chemistry', 'quantum-chemistry', 'earth-science',
+            'math', 'math-concepts', 'applications' ]
+
+LEVELS = [ 'elementary-school', 'middle-school', 'high-school', 'university' ]
+
+def generate_metadata(number_of_projects = 150, seed = 0):
+    rnd = random.Random(seed)
+
+    categories = {}
+    def add_category(category_id, name, children_ids):
+        categories[unicode(category_id)] = {
+            'id': category_id,
+            'name': name,
+            'childrenIds': children_ids,
+            'simulationIds': [],
+        }
+
+    domain_ids = range(100, 100 + len(DOMAINS))
+    level_ids = range(200, 200 + len(LEVELS))
+    add_category(1, 'root', domain_ids + [ 2, 3, 4 ])
+    add_category(2, 'by-level', level_ids)
+    add_category(3, 'html', [])
+    add_category(4, 'new', [])
+    for category_id, name in zip(domain_ids, DOMAINS):
+        add_category(category_id, name, [])
+    for category_id, name in zip(level_ids, LEVELS):
+        add_category(category_id, name, [])
+
+    projects = []
+    for position in range(number_of_projects):
+        project_id = 1000 + position
+        name = 'simulation-%s' % position
+        html = position % 3 != 0
+
+        for category_id in rnd.sample(domain_ids, rnd.randint(1, 3)) + rnd.sample(level_ids, rnd.randint(1, 3)):
+            categories[unicode(category_id)]['simulationIds'].append(project_id)
+
+        localized_simulations = []
+        for locale in [ 'en' ] + rnd.sample(LOCALES, rnd.randint(5, len(LOCALES))):
+            if html:
+                run_url = 'https://phet.colorado.edu/sims/html/%s/latest/%s_%s.html' % (name, name, locale)
+            else:
+                run_url = 'https://phet.colorado.edu/sims/%s/%s_%s.jnlp' % (name, name, locale)
+            localized_simulations.append({
+                'locale': locale,
+                'title': '%s (%s)' % (name.replace('-', ' ').title(), locale),
+                'runUrl': run_url,
+            })
+
+        projects.append({
+            'id': project_id,
+            'name': ('html/' + name) if html else name,
+            'simulations': [{
+                'name': name,
+                'description': { 'en': 'Description of %s. ' % name * 5 },
+                'localizedSimulations': localized_simulations,
+            }],
+        })
+
+    return {
+        'projects': projects,
+        'categories': categories,
+    }
+
+NAMESPACES = [ 'ACID_BASE_SOLUTIONS', 'JOIST', 'SCENERY_PHET', 'SUN', 'TANDEM', 'VEGAS' ]
+
+def generate_string_map(number_of_keys = 300, seed = 0):
+    # { locale: { 'NAMESPACE/key': 'value' } }, like the _string-map.json files
+    rnd = random.Random(seed)
+
+    keys = []
+    for position in range(number_of_keys):
+        if position % 10 == 0:
+            keys.append('key%s' % position)
+        else:
+            keys.append('%s/key.number%s' % (rnd.choice(NAMESPACES), position))
+
+    string_map = {}
+    for locale in [ 'en' ] + LOCALES:
+        string_map[locale] = dict([ (key, u'%s value in %s' % (key, locale)) for key in keys if locale == 'en' or rnd.random() < 0.9 ])
+    return string_map
+
+def generate_sim_html(string_map, size = 2 * 1024 * 1024):
+    # Like the simulation HTML files: several MB of scripts, with the line
+    # window.phet.chipper.strings = {...}; somewhere in the middle
+    filler_line = '    var x%s = "' + 'x' * 100 + '";\n'
+    filler = ''.join([ filler_line % position for position in range(size / 2 / len(filler_line)) ])
+    return ''.join([
+        '<!DOCTYPE HTML>\n<html>\n<head>\n<script type="text/javascript">\n',
+        filler,
+        '    window.phet.chipper.strings = %s;\n' % json.dumps(string_map),
+        filler,
+        '</script>\n</head>\n<body></body>\n</html>\n',
+    ])
+
+def load_sim_html_text():
+    if os.path.exists(SIM_HTML_FIXTURE):
+        return open(SIM_HTML_FIXTURE, 'rb').read()
+
+    return generate_sim_html(json.loads(load_string_map_text()))
+
+def load_string_map_text():
+    if os.path.exists(STRING_MAP_FIXTURE):
+        return open(STRING_MAP_FIXTURE, 'rb').read()
+
+    return json.dumps(generate_string_map())
+
+def load_metadata_text():
+    if os.path.exists(METADATA_FIXTURE):
+        return open(METADATA_FIXTURE, 'rb').read()
+
+    return json.dumps(generate_metadata())
+
+def record_fixtures():
+    import requests
+
+    if not os.path.exists(FIXTURES_DIR):
+        os.mkdir(FIXTURES_DIR)
+
+    for url, fixture in ((METADATA_URL, METADATA_FIXTURE), (STRING_MAP_URL, STRING_MAP_FIXTURE), (SIM_HTML_URL, SIM_HTML_FIXTURE)):
+        r = requests.get(url)
+        r.raise_for_status()
+        open(fixture, 'wb').write(r.content)
+        print "Stored %s bytes in %s" % (len(r.content), fixture)
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['record']:
+        record_fixtures()
+    else:
+        print "Usage: %s record" % sys.argv[0]
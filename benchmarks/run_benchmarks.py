@@ -0,0 +1,235 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# Runs the benchmark suite offline: the fixtures (see fixtures.py) are served
+# by a local stub server (see stub_server.py), and every request the plugin
+# sends to https://phet.colorado.edu/ goes to that server instead.
+#
+#   $ python benchmarks/run_benchmarks.py [--iterations N] [--output results.json] [benchmark ...]
+#
+# The results are printed (or stored) as JSON, so they can be compared between
+# versions.
+#
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import cPickle as pickle
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+
+# Everything must come from the stub server, not from a previous snapshot
+os.environ['G4L_PHET_SNAPSHOT'] = 'none'
+
+import g4l_rlms_phet
+
+from stub_server import FixtureServer
+from bench_catalog_memory import deep_size
+
+PHET_BASE_URLS = ( 'https://phet.colorado.edu/', 'http://phet.colorado.edu/' )
+
+class RedirectingHttpClient(g4l_rlms_phet._HttpClient):
+    def __init__(self, base_url):
+        g4l_rlms_phet._HttpClient.__init__(self)
+        self.base_url = base_url
+
+    def request(self, method, url, **kwargs):
+        for phet_base_url in PHET_BASE_URLS:
+            if url.startswith(phet_base_url):
+                url = self.base_url + url[len(phet_base_url):]
+                break
+        return g4l_rlms_phet._HttpClient.request(self, method, url, **kwargs)
+
+def reset_caches(laboratory_ids = ()):
+    g4l_rlms_phet.CATALOG.reset()
+    g4l_rlms_phet._LOCALE_TABLE.reset()
+    for key in ('get_links', 'get_links_state', 'get_laboratories', 'get_lab_url_index', 'populate_cache_last'):
+        g4l_rlms_phet.CACHE.invalidate(key)
+
+    for laboratory_id in laboratory_ids:
+        g4l_rlms_phet.PHET.cache['translations_state_{}'.format(laboratory_id)] = None
+
+def summarize(durations):
+    durations = sorted(durations)
+    return {
+        'iterations': len(durations),
+        'mean_ms': 1e3 * sum(durations) / len(durations),
+        'min_ms': 1e3 * durations[0],
+        'median_ms': 1e3 * durations[len(durations) / 2],
+        'max_ms': 1e3 * durations[-1],
+    }
+
+def measure(func, iterations, before = None):
+    durations = []
+    for _ in range(iterations):
+        if before is not None:
+            before()
+        t0 = time.time()
+        func()
+        durations.append(time.time() - t0)
+    return summarize(durations)
+
+def bench_retrieve_all_links(server, iterations):
+    result = {
+        'cold': measure(g4l_rlms_phet.retrieve_all_links, iterations, before = reset_caches),
+        'warm': measure(g4l_rlms_phet.retrieve_all_links, iterations * 100),
+    }
+
+    catalog = g4l_rlms_phet.retrieve_all_links()
+    result['laboratories'] = len(catalog)
+    result['memory_bytes'] = deep_size(catalog)
+    result['pickled_bytes'] = len(pickle.dumps(catalog, pickle.HIGHEST_PROTOCOL))
+    return result
+
+def _sample_lab_urls(laboratories):
+    urls = []
+    for lab in laboratories:
+        name = lab.laboratory_id.rsplit('/', 1)[-1]
+        urls.append(lab.laboratory_id)
+        urls.append('https://phet.colorado.edu/sims/html/%s/latest/%s_en.html' % (name, name))
+    urls.append('https://phet.colorado.edu/en/simulation/not-found')
+    return urls
+
+def bench_get_lab_by_url(server, iterations):
+    rlms = g4l_rlms_phet.RLMS("{}")
+    urls = _sample_lab_urls(rlms.get_laboratories())
+
+    def cold():
+        reset_caches()
+        g4l_rlms_phet.retrieve_all_links()
+
+    def warm():
+        for url in urls:
+            rlms.get_lab_by_url(url)
+
+    warm_result = measure(warm, iterations)
+    warm_result['per_lookup_us'] = 1e3 * warm_result['mean_ms'] / len(urls)
+    return {
+        'cold': measure(lambda : rlms.get_lab_by_url(urls[0]), iterations, before = cold),
+        'warm': warm_result,
+        'lookups': len(urls),
+    }
+
+def bench_reserve(server, iterations):
+    rlms = g4l_rlms_phet.RLMS("{}")
+    laboratory_ids = [ lab.laboratory_id for lab in rlms.get_laboratories() ]
+    locales = [ 'en', 'es', 'pt_BR', 'zh_CN', 'xx_ALL' ]
+
+    def reserve(laboratory_id, locale):
+        rlms.reserve(laboratory_id, 'tester', 'foo', '', '', '', '', locale = locale)
+
+    def cold():
+        # Only the in-process table: the catalog is still cached
+        g4l_rlms_phet._LOCALE_TABLE.reset()
+
+    def warm():
+        for laboratory_id in laboratory_ids:
+            for locale in locales:
+                reserve(laboratory_id, locale)
+
+    warm_result = measure(warm, iterations)
+    warm_result['per_call_us'] = 1e3 * warm_result['mean_ms'] / (len(laboratory_ids) * len(locales))
+    return {
+        'cold': measure(lambda : reserve(laboratory_ids[0], 'es'), iterations, before = cold),
+        'warm': warm_result,
+        'calls': len(laboratory_ids) * len(locales),
+    }
+
+def bench_populate_cache(server, iterations):
+    result = {}
+    for mode, bulk in (('bulk', True), ('tasks', False)):
+        g4l_rlms_phet.BULK_POPULATE = bulk
+        result[mode] = measure(g4l_rlms_phet.populate_cache, iterations, before = reset_caches)
+    g4l_rlms_phet.BULK_POPULATE = True
+    return result
+
+def bench_get_translations(server, iterations):
+    rlms = g4l_rlms_phet.RLMS("{}")
+    laboratory_ids = [ lab.laboratory_id for lab in rlms.get_laboratories() if '/sims/html/' in rlms.reserve(lab.laboratory_id, 'tester', 'foo', '', '', '', '')['load_url'] ]
+    laboratory_id = laboratory_ids[0]
+    string_map = server.documents['string_map'][0]
+
+    result = {}
+    # The string map first; the simulation HTML if there is no string map
+    for source, string_map_body in (('string_map', string_map), ('sim_html', None)):
+        server.set_document('string_map', string_map_body)
+        result[source] = {
+            'cold': measure(lambda : rlms.get_translations(laboratory_id), iterations, before = lambda : reset_caches([ laboratory_id ])),
+            'warm': measure(lambda : rlms.get_translations(laboratory_id), iterations * 10),
+        }
+    server.set_document('string_map', string_map)
+
+    def revalidate():
+        state = g4l_rlms_phet.PHET.cache.get('translations_state_{}'.format(laboratory_id))
+        g4l_rlms_phet.PHET.cache['translations_state_{}'.format(laboratory_id)] = dict(state, checked = 0)
+
+    rlms.get_translations(laboratory_id)
+    result['not_modified'] = measure(lambda : rlms.get_translations(laboratory_id), iterations, before = revalidate)
+
+    harvest_ids = laboratory_ids[:50]
+    result['harvest'] = measure(lambda : g4l_rlms_phet.harvest_translations(harvest_ids), 1, before = lambda : reset_caches(harvest_ids))
+    result['harvest']['laboratories'] = len(harvest_ids)
+    return result
+
+BENCHMARKS = [
+    ('retrieve_all_links', bench_retrieve_all_links),
+    ('get_lab_by_url', bench_get_lab_by_url),
+    ('reserve', bench_reserve),
+    ('populate_cache', bench_populate_cache),
+    ('get_translations', bench_get_translations),
+]
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd = BENCHMARKS_DIR, stderr = open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description = "Runs the PhET plugin benchmarks against a local stub server")
+    parser.add_argument('--iterations', type = int, default = 5)
+    parser.add_argument('--output', help = "Store the JSON results in this file instead of printing them")
+    parser.add_argument('benchmarks', nargs = '*', help = "Benchmarks to run (default: all): %s" % ', '.join([ name for name, _ in BENCHMARKS ]))
+    args = parser.parse_args()
+
+    server = FixtureServer()
+    server.start()
+    g4l_rlms_phet.HTTP = RedirectingHttpClient(server.base_url)
+    # There is a single node: no need to wait for others to compete for the lease
+    g4l_rlms_phet._Lease.SETTLE_TIME = 0
+
+    results = {}
+    for name, benchmark in BENCHMARKS:
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+
+        reset_caches()
+        hits = server.hits
+        t0 = time.time()
+        results[name] = benchmark(server, args.iterations)
+        results[name]['elapsed_s'] = time.time() - t0
+        results[name]['http_requests'] = server.hits - hits
+
+    report = {
+        'revision': get_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'iterations': args.iterations,
+        'results': results,
+    }
+
+    output = json.dumps(report, indent = 4, sort_keys = True)
+    if args.output:
+        open(args.output, 'w').write(output + '\n')
+    else:
+        print output
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# Local HTTP server which serves the fixtures as if it was PhET:
+#
+#   /services/metadata/1.0/simulations   -> metadata document
+#   /sims/html/<sim>/latest/<sim>_string-map.json -> string map (the same for every simulation)
+#   /sims/html/<sim>/latest/<sim>_<locale>.html   -> simulation HTML (the same for every simulation)
+#
+# Responses have an ETag, and conditional requests get a 304. Range requests
+# ('bytes=<start>-' or 'bytes=<start>-<end>', with If-Range: <etag>) get a 206,
+# or a 416 if they start at or past the end of the document. Requests are
+# counted in server.hits.
+#
+
+import re
+import hashlib
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from fixtures import load_metadata_text, load_string_map_text, load_sim_html_text
+
+RANGE_REGEX = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+class _FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(send_body = False)
+
+    def do_GET(self):
+        self._respond(send_body = True)
+
+    def _find_document(self, path):
+        documents = self.server.documents
+        if path.startswith('/services/metadata/'):
+            return documents.get('metadata')
+        if path.startswith('/sims/html/'):
+            if path.endswith('_string-map.json'):
+                return documents.get('string_map')
+            if path.endswith('.html'):
+                return documents.get('sim_html')
+        return None
+
+    def _respond(self, send_body):
+        self.server.count_hit()
+        document = self._find_document(self.path.split('?')[0])
+        if document is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body, etag = document
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        byte_range = self._parse_range(etag)
+        if byte_range is None:
+            self.send_response(200)
+        else:
+            start, end = byte_range
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%s' % len(body))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            end = min(end if end is not None else len(body) - 1, len(body) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, len(body)))
+            body = body[start:end + 1]
+
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _parse_range(self, etag):
+        # (start, end or None), or None if the whole document must be sent
+        match = RANGE_REGEX.match(self.headers.get('Range') or '')
+        if match is None:
+            return None
+
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range != etag:
+            # The document changed since the part was downloaded
+            return None
+
+        start, end = match.groups()
+        return int(start), int(end) if end else None
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port = 0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _FixtureHandler)
+        self.documents = {}
+        self.hits = 0
+        self._hits_lock = threading.Lock()
+        self.set_document('metadata', load_metadata_text())
+        self.set_document('string_map', load_string_map_text())
+        self.set_document('sim_html', load_sim_html_text())
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%s/' % self.server_address[1]
+
+    def set_document(self, name, body):
+        # body = None makes it a 404
+        if body is None:
+            self.documents.pop(name, None)
+        else:
+            self.documents[name] = (body, '"%s"' % hashlib.md5(body).hexdigest())
+
+    def count_hit(self):
+        with self._hits_lock:
+            self.hits += 1
+
+    def handle_error(self, request, client_address):
+        # The benchmarks close streamed responses before reading them completely
+        pass
+
+    def start(self):
+        thread = threading.Thread(target = self.serve_forever, name = 'FixtureServer')
+        thread.daemon = True
+        thread.start()
+        return self.base_url
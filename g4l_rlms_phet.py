@@ -14,13 +14,11 @@ import threading
 import Queue
 import functools
 import traceback
+import collections
+import bisect
+import heapq
+import stat
 
-import requests
-from bs4 import BeautifulSoup
-
-from flask.ext.wtf import TextField, PasswordField, Required, URL, ValidationError
-
-from labmanager.forms import AddForm
 from labmanager.rlms import register, Laboratory, CacheDisabler, LabNotFoundError
 from labmanager.rlms.base import BaseRLMS, BaseFormCreator, Capabilities, Versions
 
@@ -34,170 +32,1240 @@ def dbg_lowlevel(msg, scope):
         print "[%s][%s][%s]" % (time.asctime(), threading.current_thread().name, scope), msg
         sys.stdout.flush()
 
+METRICS_ENABLED = (os.environ.get('G4L_PHET_METRICS') or '').lower() == 'true'
+
+# Upper bounds (in seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 60, 300)
+
+class _Histogram(object):
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # The last one counts what is above LATENCY_BUCKETS[-1]
+        self.buckets = [ 0 ] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        for position, upper_bound in enumerate(LATENCY_BUCKETS):
+            if value <= upper_bound:
+                self.buckets[position] += 1
+                break
+        else:
+            self.buckets[-1] += 1
 
-class PhETAddForm(AddForm):
+    def to_dict(self):
+        buckets = collections.OrderedDict()
+        for upper_bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            buckets[str(upper_bound)] = count
+        buckets['+inf'] = self.buckets[-1]
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'buckets': buckets,
+        }
 
-    DEFAULT_URL = 'https://phet.colorado.edu/en/'
-    DEFAULT_LOCATION = 'Colorado, USA'
-    DEFAULT_PUBLICLY_AVAILABLE = True
-    DEFAULT_PUBLIC_IDENTIFIER = 'phet'
-    DEFAULT_AUTOLOAD = True
+def _cache_key_family(key):
+    # 'translations_<lab>' -> 'translations_*'; '<lab>_<locale>' -> '<lab>_<locale>'
+    if key in ('get_links', 'get_laboratories', 'get_lab_url_index', 'get_lab_query_index'):
+        return key
+    for prefix in ('translations_', 'check_url_'):
+        if key.startswith(prefix):
+            return prefix + '*'
+    return '<lab>_<locale>'
+
+class _Metrics(object):
+    # In-process latency histograms and counters. Every method returns
+    # immediately when it is disabled, so the hooks can stay in the code.
+    #
+    #   latencies = { 'reserve': _Histogram, 'http.GET': _Histogram, ... }
+    #   counters = { 'cache.get_links.hit': 3, 'http.status.200': 10, ... }
+    def __init__(self, enabled = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.latencies = {}
+            self.counters = {}
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.latencies.get(name)
+            if histogram is None:
+                histogram = self.latencies[name] = _Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, amount = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
 
-    def __init__(self, add_or_edit, *args, **kwargs):
-        super(PhETAddForm, self).__init__(*args, **kwargs)
-        self.add_or_edit = add_or_edit
+    def cache_access(self, key, hit):
+        if not self.enabled:
+            return
+        self.increment('cache.%s.%s' % (_cache_key_family(key), 'hit' if hit else 'miss'))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'since': self.started,
+                'latencies': dict([ (name, histogram.to_dict()) for name, histogram in self.latencies.iteritems() ]),
+                'counters': dict(self.counters),
+            }
 
-    @staticmethod
-    def process_configuration(old_configuration, new_configuration):
-        return new_configuration
+METRICS = _Metrics(METRICS_ENABLED)
+
+def timed(name):
+    # Decorator which stores the latency of every call in METRICS.latencies[name]
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return func(*args, **kwargs)
+
+            t0 = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                METRICS.observe(name, time.time() - t0)
+        return wrapper
+    return decorator
+
+def get_metrics():
+    return METRICS.snapshot()
+
+
+# The forms (and the flask and WTForms modules behind them) are only needed
+# by the admin panel, so PhETAddForm is created the first time it is requested
+PhETAddForm = None
+
+def _create_add_form():
+    from labmanager.forms import AddForm
+
+    class PhETAddForm(AddForm):
+
+        DEFAULT_URL = 'https://phet.colorado.edu/en/'
+        DEFAULT_LOCATION = 'Colorado, USA'
+        DEFAULT_PUBLICLY_AVAILABLE = True
+        DEFAULT_PUBLIC_IDENTIFIER = 'phet'
+        DEFAULT_AUTOLOAD = True
+
+        def __init__(self, add_or_edit, *args, **kwargs):
+            super(PhETAddForm, self).__init__(*args, **kwargs)
+            self.add_or_edit = add_or_edit
+
+        @staticmethod
+        def process_configuration(old_configuration, new_configuration):
+            return new_configuration
+
+    return PhETAddForm
 
 class PhETFormCreator(BaseFormCreator):
 
     def get_add_form(self):
+        global PhETAddForm
+        if PhETAddForm is None:
+            PhETAddForm = _create_add_form()
         return PhETAddForm
 
 FORM_CREATOR = PhETFormCreator()
 
-ALL_LINKS = None
-
 MIN_TIME = datetime.timedelta(hours=24)
 
+PHET_URL = os.environ.get('G4L_PHET_URL') or 'https://phet.colorado.edu/'
+
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('G4L_PHET_CONNECT_TIMEOUT') or 10)
+HTTP_READ_TIMEOUT = float(os.environ.get('G4L_PHET_READ_TIMEOUT') or 60)
+HTTP_RETRIES = int(os.environ.get('G4L_PHET_HTTP_RETRIES') or 3)
+HTTP_BACKOFF = 0.5
+
+# requests is imported on the first request (see _import_requests)
+requests = None
+
+def _import_requests():
+    global requests
+    if requests is None:
+        import requests
+        import requests.adapters
+    return requests
+
+class _HttpClient(object):
+    # Every request to PhET goes through here: one keep-alive connection pool
+    # shared by all the threads, connect/read timeouts, and exponential backoff
+    # on connection errors, timeouts and 5xx responses.
+    def __init__(self, pool_size = None, timeout = None, retries = None, backoff = None):
+        self.pool_size = pool_size
+        self.timeout = timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        self.retries = HTTP_RETRIES if retries is None else retries
+        self.backoff = HTTP_BACKOFF if backoff is None else backoff
+        self._lock = threading.Lock()
+        self._session = None
+
+    def _create_adapter(self):
+        _import_requests()
+        pool_size = self.pool_size or NUM_THREADS
+        return requests.adapters.HTTPAdapter(pool_connections = 4, pool_maxsize = pool_size)
+
+    def _mount(self, session):
+        session.mount('http://', self._create_adapter())
+        session.mount('https://', self._create_adapter())
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = _import_requests().Session()
+                    self._mount(session)
+                    self._session = session
+        return self._session
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('HEAD', url, **kwargs)
+
+    def request(self, method, url, retries = None, **kwargs):
+        _import_requests()
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.session
+
+        if retries is None:
+            retries = self.retries
+
+        attempt = 0
+        while True:
+            t0 = time.time()
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                METRICS.observe('http.%s' % method, time.time() - t0)
+                METRICS.increment('http.errors')
+                if attempt >= retries:
+                    raise
+                dbg_lowlevel("Connection error retrieving %s; retrying" % url, scope = 'http')
+            else:
+                METRICS.observe('http.%s' % method, time.time() - t0)
+                METRICS.increment('http.status.%s' % response.status_code)
+                if response.status_code < 500 or attempt >= retries:
+                    return response
+                dbg_lowlevel("Error %s retrieving %s; retrying" % (response.status_code, url), scope = 'http')
+                response.close()
+
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt = attempt + 1
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+HTTP = _HttpClient()
+
+LOCAL_CACHE_SIZE = int(os.environ.get('G4L_PHET_LOCAL_CACHE_SIZE') or 128)
+# Entries of the local cache are checked again against the shared cache after this
+# time, so changes made by other processes are seen
+LOCAL_CACHE_MAX_AGE = datetime.timedelta(minutes = 5)
+# Time after which a rebuild lock held by another thread or process is ignored
+REBUILD_LOCK_TIMEOUT = datetime.timedelta(minutes = 10)
+# Maximum time a request waits for another process rebuilding a key before
+# rebuilding it itself (e.g., if that process died holding the lock): about
+# as long as a request to PhET may take
+REBUILD_WAIT_TIMEOUT = datetime.timedelta(seconds = HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT)
+
+# Time to live of each key family. Keys not listed use MIN_TIME
+CACHE_TTLS = {
+    'get_links': MIN_TIME,
+    'get_laboratories': MIN_TIME,
+    'get_lab_url_index': MIN_TIME,
+    'get_lab_query_index': MIN_TIME,
+    'check_url_': datetime.timedelta(hours = 1),
+}
+
+PROCESS_ID = '%s-%s' % (os.getpid(), uuid.uuid4().hex)
+
+def _process_id():
+    # Processes forked after the import (e.g., LabManager workers) get their own identifier
+    global PROCESS_ID
+    if not PROCESS_ID.startswith('%s-' % os.getpid()):
+        PROCESS_ID = '%s-%s' % (os.getpid(), uuid.uuid4().hex)
+    return PROCESS_ID
+
+class _TwoTierCache(object):
+    # Facade on the shared cache (PHET.cache by default, shared among processes)
+    # with a bounded in-process LRU in front of it. get_or_compute() makes sure
+    # that only one thread (and if possible, one process) rebuilds an expired
+    # key, while the rest keep getting the expired (stale) value, if there is
+    # one, in the meanwhile.
+    #
+    # Every read and write of the shared cache in this module goes through
+    # shared, so it can be replaced (e.g., by an in-memory stand-in shared by
+    # several local processes, see benchmarks/check_populate_lease.py).
+    def __init__(self, size = None, shared = None):
+        self.size = size or LOCAL_CACHE_SIZE
+        self._shared = shared
+        self._local = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    @property
+    def shared(self):
+        return PHET.cache if self._shared is None else self._shared
+
+    @shared.setter
+    def shared(self, cache):
+        self._shared = cache
+
+    def ttl(self, key):
+        for family, ttl in CACHE_TTLS.iteritems():
+            if key == family or (family.endswith('_') and key.startswith(family)):
+                return ttl
+        return MIN_TIME
+
+    def _local_get(self, key):
+        # Returns (value, stored) or (None, None)
+        with self._lock:
+            item = self._local.pop(key, None)
+            if item is None:
+                return None, None
+            self._local[key] = item
+            return item
+
+    def _local_set(self, key, value, stored = None):
+        with self._lock:
+            self._local.pop(key, None)
+            self._local[key] = (value, stored or time.time())
+            while len(self._local) > self.size:
+                self._local.popitem(last = False)
+
+    def get(self, key, valid = None):
+        # Fresh value or None
+        value, stored = self._local_get(key)
+        if value is not None:
+            age = time.time() - stored
+            if age < min(self.ttl(key), LOCAL_CACHE_MAX_AGE).total_seconds():
+                METRICS.cache_access(key, hit = True)
+                return value
+
+        value = self.shared.get(key, min_time = self.ttl(key))
+        if value is None or (valid is not None and not valid(value)):
+            METRICS.cache_access(key, hit = False)
+            return None
+
+        METRICS.cache_access(key, hit = True)
+        self._local_set(key, value)
+        return value
+
+    def get_stale(self, key, valid = None):
+        # Any value, even if expired, or None
+        value, _ = self._local_get(key)
+        if value is None:
+            value = self.shared.get(key)
+
+        if value is None or (valid is not None and not valid(value)):
+            return None
+        return value
+
+    def seed(self, key, value, stored):
+        # Only in this process, as if it had been stored at 'stored' (e.g., from a snapshot)
+        self._local_set(key, value, stored)
+
+    def set(self, key, value):
+        self._local_set(key, value)
+        self.shared[key] = value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._local.pop(key, None)
+        # The cache does not support deletions, but every reader treats None as a miss
+        self.shared[key] = None
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def _acquire_shared_lock(self, key):
+        # Best effort: self.shared has no atomic operations, so two processes
+        # might eventually both rebuild a key, but not all of them at once
+        LOCK_KEY = 'rebuild_lock_{}'.format(key)
+        current = self.shared.get(LOCK_KEY)
+        if current and current['owner'] != _process_id() and current['expires'] > time.time():
+            return False
+
+        self.shared[LOCK_KEY] = {
+            'owner': _process_id(),
+            'expires': time.time() + REBUILD_LOCK_TIMEOUT.total_seconds(),
+        }
+        current = self.shared.get(LOCK_KEY)
+        return current is not None and current['owner'] == _process_id()
+
+    def _release_shared_lock(self, key):
+        LOCK_KEY = 'rebuild_lock_{}'.format(key)
+        current = self.shared.get(LOCK_KEY)
+        if current is None or current['owner'] == _process_id():
+            self.shared[LOCK_KEY] = None
+
+    def get_or_compute(self, key, compute, valid = None):
+        value = self.get(key, valid)
+        if value is not None:
+            return value
+
+        stale = self.get_stale(key, valid)
+        lock = self._key_lock(key)
+
+        if stale is not None:
+            # Stale-while-revalidate: one background thread rebuilds the key
+            if lock.acquire(False):
+                thread = threading.Thread(target = self._rebuild, args = (key, compute, valid, lock, stale), name = 'Rebuild-%s' % key)
+                thread.daemon = True
+                thread.start()
+            return stale
+
+        with lock:
+            # Another thread might have rebuilt it while waiting
+            value = self.get(key, valid)
+            if value is not None:
+                return value
+
+            return self._compute(key, compute, valid, wait_for_others = True)
+
+    def _rebuild(self, key, compute, valid, lock, stale):
+        try:
+            self._compute(key, compute, valid, wait_for_others = False)
+        except:
+            dbg("Error rebuilding %s; still using the stale value" % key)
+            traceback.print_exc()
+        finally:
+            lock.release()
+
+    def _compute(self, key, compute, valid, wait_for_others):
+        if not self._acquire_shared_lock(key):
+            if not wait_for_others:
+                return None
+
+            # Another process is rebuilding it: wait for it for a while
+            deadline = time.time() + REBUILD_WAIT_TIMEOUT.total_seconds()
+            while time.time() < deadline:
+                time.sleep(0.5)
+                value = self.get(key, valid)
+                if value is not None:
+                    return value
+                current = self.shared.get('rebuild_lock_{}'.format(key))
+                if current is None or current['expires'] <= time.time():
+                    break
+
+        try:
+            value = compute()
+            self.set(key, value)
+            return value
+        finally:
+            self._release_shared_lock(key)
+
+CACHE = _TwoTierCache()
+
+class PhETCatalogEntry(object):
+    # One laboratory of the catalog. Instead of one dict per locale with the
+    # link, the name and the run URL, it stores:
+    #
+    #   locales = { 'es_ALL': (u'Localized name', 'es'), 'pt_BR': (u'Name', 'http://full/url') }
+    #   aliases = { 'pt_ALL': 'pt_BR', 'zh_ALL': 'zh_CN' }
+    #
+    # where the second element is either the part of the run URL between
+    # url_prefix and url_suffix (usually the PhET locale code), or the full run
+    # URL if it does not follow that pattern.
+    __slots__ = ('link', 'description', 'domains', 'age_ranges', 'url_prefix', 'url_suffix', 'locales', 'aliases')
+
+    def __init__(self, link, description, domains = (), age_ranges = ()):
+        self.link = link
+        self.description = description
+        self.domains = tuple(domains)
+        self.age_ranges = tuple(age_ranges)
+        self.url_prefix = None
+        self.url_suffix = None
+        self.locales = {}
+        self.aliases = {}
+
+    def __repr__(self):
+        return 'PhETCatalogEntry(link=%r, languages=%r)' % (self.link, len(self.locales) + len(self.aliases))
+
+    def __getstate__(self):
+        return dict([ (name, getattr(self, name)) for name in self.__slots__ ])
+
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, state[name])
+
+    def __eq__(self, other):
+        if not isinstance(other, PhETCatalogEntry):
+            return False
+        return self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __contains__(self, locale):
+        return locale in self.locales or locale in self.aliases
+
+    def copy(self, domains, age_ranges):
+        entry = PhETCatalogEntry(self.link, self.description, domains, age_ranges)
+        entry.url_prefix = self.url_prefix
+        entry.url_suffix = self.url_suffix
+        entry.locales = self.locales
+        entry.aliases = self.aliases
+        return entry
+
+    def add_locale(self, locale, name, run_url, url_locale, strings):
+        if self.url_prefix is None and url_locale in run_url:
+            position = run_url.rfind(url_locale)
+            self.url_prefix = strings.setdefault(run_url[:position], run_url[:position])
+            self.url_suffix = strings.setdefault(run_url[position + len(url_locale):], run_url[position + len(url_locale):])
+
+        if self.url_prefix is not None and run_url == self.url_prefix + url_locale + self.url_suffix:
+            url = strings.setdefault(url_locale, url_locale)
+        else:
+            url = run_url
+
+        locale = strings.setdefault(locale, locale)
+        self.aliases.pop(locale, None)
+        self.locales[locale] = (strings.setdefault(name, name), url)
+
+    def add_alias(self, alias, locale, strings):
+        alias = strings.setdefault(alias, alias)
+        self.locales.pop(alias, None)
+        self.aliases[alias] = self.aliases.get(locale, locale)
+
+    def languages(self):
+        return self.locales.keys() + self.aliases.keys()
+
+    def _lookup(self, locale):
+        return self.locales.get(self.aliases.get(locale, locale))
+
+    def _run_url(self, url):
+        if '/' in url:
+            return url
+        return self.url_prefix + url + self.url_suffix
+
+    def name(self, locale):
+        value = self._lookup(locale)
+        if value is None:
+            return None
+        return value[0]
+
+    def run_url(self, locale):
+        value = self._lookup(locale)
+        if value is None:
+            return None
+        return self._run_url(value[1])
+
+    def get_localized(self, locale):
+        # Same format as the former all_links[link]['localized'][locale]
+        value = self._lookup(locale)
+        if value is None:
+            return None
+        return {
+            'link': self.link,
+            'name': value[0],
+            'run_url': self._run_url(value[1]),
+        }
+
+    def to_data(self):
+        # Only lists, dicts and strings (e.g., for JSON); see from_data
+        return {
+            'link': self.link,
+            'description': self.description,
+            'domains': list(self.domains),
+            'age_ranges': list(self.age_ranges),
+            'url_prefix': self.url_prefix,
+            'url_suffix': self.url_suffix,
+            'locales': dict([ (locale, list(value)) for locale, value in self.locales.iteritems() ]),
+            'aliases': self.aliases,
+        }
+
+    @classmethod
+    def from_data(cls, data, strings):
+        # strings is shared by the entries of a catalog, as when it is built
+        def intern(value):
+            return strings.setdefault(value, value)
+
+        entry = cls(intern(data['link']), data['description'], [ intern(domain) for domain in data['domains'] ], [ intern(age_range) for age_range in data['age_ranges'] ])
+        entry.url_prefix = intern(data['url_prefix'])
+        entry.url_suffix = intern(data['url_suffix'])
+        entry.locales = dict([ (intern(locale), (intern(name), intern(url))) for locale, (name, url) in data['locales'].iteritems() ])
+        entry.aliases = dict([ (intern(alias), intern(locale)) for alias, locale in data['aliases'].iteritems() ])
+        return entry
+
+    def to_dict(self):
+        return {
+            'localized': dict([ (locale, self.get_localized(locale)) for locale in self.languages() ]),
+            'metadata': {
+                'domains': list(self.domains),
+                'age_ranges': list(self.age_ranges),
+                'description': self.description,
+            }
+        }
+
+class PhETCatalog(object):
+    # Read-only mapping of laboratory identifier (e.g.,
+    # 'http://phet.colorado.edu/en/simulation/acid-base-solutions') to PhETCatalogEntry
+    # version identifies the contents: equal catalogs built in different
+    # processes have the same version. created is when it was built.
+    #
+    # It also keeps a language index, so it is stored (and expires) with it:
+    #   languages = [ 'ar_ALL', 'de_ALL', ... ]  (sorted)
+    #   labs_by_language = { 'ar_ALL': frozenset([ laboratory_id1, ... ]) }
+    #
+    # Catalogs are never modified once built: a refresh builds a new one and
+    # publishes it (see _CatalogPublisher).
+    __slots__ = ('entries', 'version', 'created', 'languages', 'labs_by_language')
+
+    def __init__(self, entries = None, version = None, created = None):
+        self.entries = entries or {}
+        self.version = version
+        self.created = time.time() if created is None else created
+        self._index_languages()
+
+    def _index_languages(self):
+        labs_by_language = {}
+        for link, entry in self.entries.iteritems():
+            for language in entry.languages():
+                labs_by_language.setdefault(language, set()).add(link)
+
+        self.labs_by_language = dict([ (language, frozenset(links)) for language, links in labs_by_language.iteritems() ])
+        self.languages = sorted(self.labs_by_language.keys())
+
+    def __repr__(self):
+        return 'PhETCatalog(%s laboratories, version=%r)' % (len(self.entries), self.version)
+
+    def __getstate__(self):
+        return { 'entries': self.entries, 'version': self.version, 'created': self.created, 'languages': self.languages, 'labs_by_language': self.labs_by_language }
+
+    def __setstate__(self, state):
+        self.entries = state['entries']
+        self.version = state.get('version')
+        self.created = state.get('created', 0)
+        if 'labs_by_language' in state:
+            self.languages = state['languages']
+            self.labs_by_language = state['labs_by_language']
+        else:
+            self._index_languages()
+
+    def to_data(self):
+        return {
+            'version': self.version,
+            'created': self.created,
+            'entries': [ entry.to_data() for entry in self.entries.itervalues() ],
+        }
+
+    @classmethod
+    def from_data(cls, data):
+        strings = {}
+        entries = {}
+        for entry_data in data['entries']:
+            entry = PhETCatalogEntry.from_data(entry_data, strings)
+            entries[entry.link] = entry
+        return cls(entries, data['version'], data['created'])
+
+    def laboratory_ids_in(self, language):
+        return self.labs_by_language.get(language, frozenset())
+
+    def __eq__(self, other):
+        return isinstance(other, PhETCatalog) and self.entries == other.entries
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, link):
+        return link in self.entries
+
+    def __getitem__(self, link):
+        return self.entries[link]
+
+    def get(self, link, default = None):
+        return self.entries.get(link, default)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def values(self):
+        return self.entries.values()
+
+    def iteritems(self):
+        return self.entries.iteritems()
+
+    def to_dict(self):
+        # The format all_links had before PhETCatalog
+        return dict([ (link, entry.to_dict()) for link, entry in self.entries.iteritems() ])
+
+class PhETCatalogSnapshot(object):
+    # The catalog used by this process, as published by CATALOG. It is never
+    # modified: every publish() creates a new one. generation is increased
+    # every time a different catalog is published, so anything derived from a
+    # catalog (e.g., the _LocaleFallbackTable) can tell whether it is current
+    # by comparing a number.
+    __slots__ = ('catalog', 'generation', 'checked')
+
+    def __init__(self, catalog, generation, checked):
+        self.catalog = catalog
+        self.generation = generation
+        self.checked = checked
+
+    def __repr__(self):
+        return 'PhETCatalogSnapshot(%r, generation=%r)' % (self.catalog, self.generation)
+
+class _CatalogPublisher(object):
+    # Readers get the current snapshot by reading one attribute, without
+    # locks. A refresh builds the new catalog on the side and publish() swaps
+    # the reference, so readers see either the previous catalog or the new
+    # one, never something in between.
+    def __init__(self):
+        self._snapshot = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def current(self):
+        return self._snapshot
+
+    def publish(self, catalog):
+        with self._lock:
+            current = self._snapshot
+            if current is not None and (catalog is current.catalog or catalog.version == current.catalog.version or catalog.created < current.catalog.created):
+                # Same contents, or an older catalog (e.g., a stale value still
+                # in the cache): the current one is kept, as just checked
+                snapshot = PhETCatalogSnapshot(current.catalog, current.generation, time.time())
+            else:
+                self._generation += 1
+                snapshot = PhETCatalogSnapshot(catalog, self._generation, time.time())
+            self._snapshot = snapshot
+            return snapshot
+
+    def expire(self):
+        # The current catalog is kept, but the next reader checks the cache again
+        with self._lock:
+            current = self._snapshot
+            if current is not None:
+                self._snapshot = PhETCatalogSnapshot(current.catalog, current.generation, 0)
+
+    def reset(self):
+        # Generations keep increasing, so nothing built before is taken as current
+        with self._lock:
+            self._snapshot = None
+
+CATALOG = _CatalogPublisher()
+
 def get_languages():
-    all_links = retrieve_all_links()
-    languages = set()
-    for link_data in all_links.values():
-        languages.update(link_data['localized'].keys())
+    return list(retrieve_all_links().languages)
+
+def get_laboratories_in_language(language):
+    # Laboratories available in language (e.g., 'es_ALL'), sorted by identifier
+    return retrieve_lab_query_index().laboratories_in_language(language)
+
+METADATA_URL = PHET_URL + "services/metadata/1.0/simulations?format=json"
+
+# When enabled, the metadata document is requested with the ETag / Last-Modified
+# of the previous download, and only the projects that changed are rebuilt
+INCREMENTAL_REFRESH = (os.environ.get('G4L_PHET_INCREMENTAL') or 'true').lower() == 'true'
+
+# If ijson is installed, the metadata document is parsed while it is downloaded
+STREAMING_METADATA = (os.environ.get('G4L_PHET_STREAMING') or 'true').lower() == 'true'
 
-    return sorted(list(languages))
+# ijson is imported on the first download of the metadata (see _import_ijson).
+# False means that it is not installed.
+ijson = None
+
+def _import_ijson():
+    global ijson
+    if ijson is None:
+        try:
+            import ijson
+            import ijson.common
+        except ImportError:
+            ijson = False
+    return ijson or None
 
 def retrieve_all_links():
-    KEY = 'get_links'
-    all_links = PHET.cache.get(KEY, min_time = MIN_TIME)
-    if all_links:
-        return all_links
-
-    # If it is in a global variable
-    all_links = ALL_LINKS
-    if all_links:
-        return all_links
-
-    all_links = {
-        # "http://phet.colorado.edu/en/simulation/acid-base-solutions" : {
-        #      # lang_code: {
-        #            'link' : 'http://phet.colorado.edu/pt/simulation/acid-base-solutions',
-        #            'name' : 'Localized name',
-        #            'run_url': '<html to be loaded>'
-        #      # }
-        # }
+    # The published catalog is used as it is while it was checked against the
+    # cache recently, so other processes' refreshes are eventually seen
+    snapshot = CATALOG.current()
+    if snapshot is not None and time.time() - snapshot.checked < LOCAL_CACHE_MAX_AGE.total_seconds():
+        METRICS.cache_access('get_links', hit = True)
+        return snapshot.catalog
+
+    _load_snapshot_once()
+    # Entries stored by versions without PhETCatalog are ignored
+    catalog = CACHE.get_or_compute('get_links', _download_all_links, valid = lambda value: isinstance(value, PhETCatalog))
+    return CATALOG.publish(catalog).catalog
+
+# If G4L_PHET_SNAPSHOT is the path of a file, the catalog is also stored there
+# after every refresh, so new processes can serve it right away (even offline)
+# while it is refreshed in the background. It is a JSON document, and it is
+# ignored unless it belongs to the user running the process and nobody else
+# can write it, since its contents are shared with every node through the cache.
+SNAPSHOT_PATH = os.environ.get('G4L_PHET_SNAPSHOT') or None
+if SNAPSHOT_PATH is not None and SNAPSHOT_PATH.lower() == 'none':
+    SNAPSHOT_PATH = None
+
+SNAPSHOT_MAGIC = 'G4L-PHET-SNAPSHOT'
+SNAPSHOT_FORMAT = 2
+
+def _write_snapshot(state, path = None):
+    # state is the get_links_state plus the catalog: { 'validators': ..., 'projects': ..., 'all_links': PhETCatalog }
+    path = path or SNAPSHOT_PATH
+    if path is None:
+        return False
+
+    snapshot = {
+        'created': time.time(),
+        'validators': state['validators'],
+        # JSON objects only have string keys, and project identifiers are numbers
+        'projects': state['projects'].items(),
+        'catalog': state['all_links'].to_data(),
     }
-    
+
+    try:
+        tmp_path = '%s.%s.tmp' % (path, _process_id())
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb') as f:
+            f.write('%s %s\n' % (SNAPSHOT_MAGIC, SNAPSHOT_FORMAT))
+            json.dump(snapshot, f)
+        # Atomic replacement: readers never see a half-written snapshot
+        os.rename(tmp_path, path)
+        return True
+    except:
+        traceback.print_exc()
+        return False
+
+def _trusted_snapshot(f, path):
+    st = os.fstat(f.fileno())
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        dbg("Ignoring snapshot %s: it belongs to another user" % path)
+        return False
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        dbg("Ignoring snapshot %s: other users can write it" % path)
+        return False
+    return True
+
+def _read_snapshot(path = None):
+    # Returns (created, state) or (None, None)
+    path = path or SNAPSHOT_PATH
+    if path is None or not os.path.exists(path):
+        return None, None
+
+    try:
+        with open(path, 'rb') as f:
+            if not _trusted_snapshot(f, path):
+                return None, None
+            if f.readline().strip() != '%s %s' % (SNAPSHOT_MAGIC, SNAPSHOT_FORMAT):
+                dbg("Ignoring snapshot %s: unknown format" % path)
+                return None, None
+            snapshot = json.load(f)
+
+        state = {
+            'validators': snapshot['validators'],
+            'projects': dict([ (project_id, project) for project_id, project in snapshot['projects'] ]),
+            'all_links': PhETCatalog.from_data(snapshot['catalog']),
+        }
+    except:
+        traceback.print_exc()
+        return None, None
+
+    return snapshot['created'], state
+
+def load_snapshot(path = None):
+    # Makes the catalog in the snapshot available to this process. If it is
+    # older than MIN_TIME, it is served as a stale value and refreshed in the
+    # background on first use.
+    created, state = _read_snapshot(path)
+    if state is None:
+        return False
+
+    CACHE.seed('get_links', state['all_links'], created)
+    if INCREMENTAL_REFRESH and CACHE.shared.get('get_links_state') is None:
+        # So the refresh can be a conditional request
+        CACHE.shared['get_links_state'] = {
+            'validators': state['validators'],
+            'projects': state['projects'],
+            'version': state['all_links'].version,
+        }
+
+    dbg("Catalog snapshot loaded (%s laboratories, %.0f seconds old)" % (len(state['all_links']), time.time() - created))
+    return True
+
+SNAPSHOT_LOADED = False
+_SNAPSHOT_LOCK = threading.Lock()
+
+def _load_snapshot_once():
+    # The snapshot is read when the catalog is first needed, not on import
+    global SNAPSHOT_LOADED
+    if SNAPSHOT_LOADED:
+        return
+
+    with _SNAPSHOT_LOCK:
+        if not SNAPSHOT_LOADED:
+            try:
+                load_snapshot()
+            finally:
+                SNAPSHOT_LOADED = True
+
+def _previous_catalog(version):
+    # The catalog a get_links_state was stored with: the published one, or
+    # the one in the cache even if it expired. None if neither is that version.
+    snapshot = CATALOG.current()
+    if snapshot is not None and snapshot.catalog.version == version:
+        return snapshot.catalog
+
+    catalog = CACHE.get_stale('get_links', valid = lambda value: isinstance(value, PhETCatalog))
+    if catalog is not None and catalog.version == version:
+        return catalog
+    return None
+
+def _download_all_links():
+    # get_links_state only stores the validators and the project fingerprints
+    # of the catalog in get_links (and its version, to match them). Without
+    # that catalog, the metadata document is downloaded and built from scratch.
+    STATE_KEY = 'get_links_state'
+    previous_state = None
+    if INCREMENTAL_REFRESH:
+        stored_state = CACHE.shared.get(STATE_KEY)
+        if stored_state and 'version' in stored_state:
+            previous_links = _previous_catalog(stored_state['version'])
+            if previous_links is not None:
+                previous_state = dict(stored_state, all_links = previous_links)
+
+    if previous_state:
+        validators = previous_state['validators']
+    else:
+        validators = {}
+
+    all_links, projects, validators = _fetch_all_links(validators, previous_state)
+    if all_links is None:
+        # 304 Not Modified: the previous catalog is still valid
+        dbg("PhET metadata not modified")
+        _write_snapshot(previous_state)
+        return CATALOG.publish(previous_state['all_links']).catalog
+
+    # Published right away, also when it is rebuilt in the background, and
+    # before the derived keys are invalidated, so they are not rebuilt from
+    # the previous catalog
+    CATALOG.publish(all_links)
+
+    if previous_state:
+        _invalidate_changed_links(previous_state, all_links, projects)
+
+    state = {
+        'validators': validators,
+        'projects': projects,
+        'version': all_links.version,
+    }
+    if INCREMENTAL_REFRESH:
+        CACHE.shared[STATE_KEY] = state
+
+    _write_snapshot(dict(state, all_links = all_links))
+    return all_links
+
+def _fetch_all_links(validators, previous_state):
+    # Returns (all_links, projects, validators). all_links is None if PhET replied 304 Not Modified
+    streaming = STREAMING_METADATA and _import_ijson() is not None
+    if streaming:
+        metadata_errors = (ValueError, ijson.JSONError)
+    else:
+        metadata_errors = (ValueError,)
+
     trials = 0
 
     while True:
+        headers = {}
+        if trials == 0:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        else:
+            headers['Cache-Control'] = 'no-cache'
+
         try:
-            if trials == 0:
-                kwargs = {}
-            else:
-                kwargs = dict(headers={'Cache-Control': 'no-cache'})
-            contents = requests.get("https://phet.colorado.edu/services/metadata/1.0/simulations?format=json", **kwargs).json()
-        except ValueError:
+            r = HTTP.get(METADATA_URL, headers = headers, stream = streaming)
+            try:
+                if r.status_code == 304 and trials == 0 and headers:
+                    return None, None, validators
+
+                if streaming:
+                    r.raw.decode_content = True
+                    all_links, projects = _build_all_links_streaming(r.raw, previous_state)
+                else:
+                    all_links, projects = _build_all_links(r.json(), previous_state)
+            finally:
+                r.close()
+        except metadata_errors:
             trials = trials + 1
             if trials >= 3:
                 raise
         else:
             break
-    available_names = [ x['name'] for x in contents['projects'] ]
-    
-    categories = {}
-    fetch_children_recursively(contents['categories'], contents['categories']['1'], categories, 10)
-
-    levels = dict([ 
-                    (v['name'], v['simulationIds']) 
-                    for v in contents['categories'].values() 
-                    if v['name'] in ('high-school', 'university', 'elementary-school', 'middle-school') 
-            ])
-    
+
+    new_validators = {
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+    }
+    return all_links, projects, new_validators
+
+def _build_all_links(contents, previous_state = None):
+    builder = _CatalogBuilder(previous_state)
     for simulation in contents['projects']:
-        current_name = simulation['name']
-        if ('html/' + simulation['name']) in available_names:
+        builder.add_project(simulation)
+    return builder.finish(contents['categories'])
+
+def _build_all_links_streaming(stream, previous_state = None):
+    # Same as _build_all_links, but parsing the metadata document from a file-like
+    # object: only one project is decoded at a time
+    builder = _CatalogBuilder(previous_state)
+    phet_categories = None
+
+    events = _import_ijson().parse(stream)
+    for prefix, event, value in events:
+        if event != 'start_map':
             continue
+        if prefix == 'projects.item':
+            builder.add_project(_read_json_object(events))
+        elif prefix == 'categories':
+            phet_categories = _read_json_object(events)
+
+    if phet_categories is None:
+        raise ValueError("No categories found in the PhET metadata")
+
+    return builder.finish(phet_categories)
+
+def _read_json_object(events):
+    # Consumes ijson events until the object that has just been opened is closed
+    import decimal
+    builder = ijson.common.ObjectBuilder()
+    builder.event('start_map', None)
+    depth = 1
+    for _, event, value in events:
+        if event == 'number' and isinstance(value, decimal.Decimal):
+            value = float(value)
+        builder.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if depth == 0:
+                break
+    return builder.value
+
+class _CatalogBuilder(object):
+    # Builds the PhETCatalog one project at a time (so it can be fed from a
+    # stream), and returns (all_links, projects) once the categories are known,
+    # where projects is:
+    # {
+    #     project_id: {
+    #         'project_fingerprint': 'sha1 of the project data',
+    #         'fingerprint': 'sha1 of the project data and its domains and age ranges',
+    #         'links': [ link1, link2 ],
+    #     }
+    # }
+    # Projects which did not change since previous_state are copied from the
+    # previous all_links rather than rebuilt.
+    def __init__(self, previous_state = None):
+        if previous_state:
+            self.previous_projects = previous_state['projects']
+            self.previous_links = previous_state['all_links']
+        else:
+            self.previous_projects = {}
+            self.previous_links = {}
+
+        self.strings = {}
+        self.available_names = set()
+        self.projects = [
+            # (project_id, name, project_fingerprint, project_links or None if it can be reused)
+        ]
+
+    def add_project(self, simulation):
+        project_fingerprint = hashlib.sha1(json.dumps(simulation, sort_keys = True)).hexdigest()
+
+        previous_project = self.previous_projects.get(simulation['id'])
+        if self._reusable(previous_project) and previous_project.get('project_fingerprint') == project_fingerprint:
+            project_links = None
+        else:
+            project_links = _build_project_links(simulation, self.strings)
 
-        for real_sim in simulation['simulations']:
-            link = "http://phet.colorado.edu/en/simulation/%s" % real_sim['name']
-
-            sim_links = {
-                'localized': {
-                    # lang_code: {
-                    #     link
-                    #     name
-                    #     run_url
-                    # }
-                },
-                'metadata': {
-                    'domains': [],
-                    'age_ranges': [],
-                    'description': real_sim['description']['en'],
-                }
+        self.available_names.add(simulation['name'])
+        self.projects.append((simulation['id'], simulation['name'], project_fingerprint, project_links))
+
+    def _reusable(self, previous_project):
+        if previous_project is None:
+            return False
+        return all([ link in self.previous_links for link in previous_project['links'] ])
+
+    def finish(self, phet_categories):
+        all_links = {
+            # "http://phet.colorado.edu/en/simulation/acid-base-solutions" : PhETCatalogEntry(...)
+        }
+        projects = {}
+
+        categories = {}
+        fetch_children_recursively(phet_categories, phet_categories['1'], categories, 10)
+
+        levels = dict([ 
+                        (v['name'], v['simulationIds']) 
+                        for v in phet_categories.values() 
+                        if v['name'] in ('high-school', 'university', 'elementary-school', 'middle-school') 
+                ])
+
+        metadata_by_id = _build_metadata_by_id(categories, levels)
+
+        rebuilt = 0
+        for project_id, name, project_fingerprint, project_links in self.projects:
+            if ('html/' + name) in self.available_names:
+                continue
+
+            domains, age_ranges = metadata_by_id.get(project_id, ((), ()))
+            fingerprint = hashlib.sha1(json.dumps([ project_fingerprint, domains, age_ranges ])).hexdigest()
+
+            if project_links is None:
+                previous_project = self.previous_projects[project_id]
+                project_links = dict([ (link, self.previous_links[link]) for link in previous_project['links'] ])
+                if previous_project['fingerprint'] != fingerprint:
+                    # Same project, but in different categories or levels
+                    rebuilt = rebuilt + 1
+                    project_links = dict([ (link, entry.copy(domains, age_ranges)) for link, entry in project_links.iteritems() ])
+            else:
+                rebuilt = rebuilt + 1
+                _set_project_metadata(project_links, domains, age_ranges)
+
+            all_links.update(project_links)
+            projects[project_id] = {
+                'project_fingerprint': project_fingerprint,
+                'fingerprint': fingerprint,
+                'links': list(project_links.keys()),
             }
-            for category_name, simulation_ids in categories.iteritems():
-                if simulation['id'] in simulation_ids:
-                    sim_links['metadata']['domains'].append(category_name)
-
-            for level_name, simulation_ids in levels.iteritems():
-                if simulation['id'] in simulation_ids:
-                    if level_name == 'university':
-                        sim_links['metadata']['age_ranges'].append('>18')
-                    elif level_name == 'high-school':
-                        sim_links['metadata']['age_ranges'].append('14-16')
-                        sim_links['metadata']['age_ranges'].append('16-18')
-                    elif level_name == 'middle-school':
-                        sim_links['metadata']['age_ranges'].append('10-12')
-                        sim_links['metadata']['age_ranges'].append('12-14')
-                    elif level_name == 'elementary-school':
-                        sim_links['metadata']['age_ranges'].append('8-10')
-                        sim_links['metadata']['age_ranges'].append('6-8')
-                        sim_links['metadata']['age_ranges'].append('<6')
-
-            available_langs = [ x['locale'] for x in real_sim['localizedSimulations'] ]
-            for localized_sim in real_sim['localizedSimulations']:
-                lang = localized_sim['locale']
-                if '_' not in lang:
-                    lang = lang + "_ALL"
-
-                sim_links['localized'][lang] = {
-                    'link' : link,
-                    'name': localized_sim['title'],
-                    'run_url': localized_sim['runUrl'].replace('https://', 'http://'),
-                }
-
-                if lang == 'zh_CN':
-                    sim_links['localized']['zh_ALL'] = {
-                        'link' : link,
-                        'name': localized_sim['title'],
-                        'run_url': localized_sim['runUrl'].replace('https://', 'http://'),
-                    }
-
-            # Repeat filling the spaces (e.g., xx_YY will also be xx_ALL). Only if needed
-            for localized_sim in real_sim['localizedSimulations']:
-                lang = localized_sim['locale']
-                if '_' not in lang:
-                    # 'es' is already default, so no issue
-                    continue
 
-                generalized_lang = lang.split('_')[0] + '_ALL'
+        dbg("%s out of %s PhET projects rebuilt" % (rebuilt, len(projects)))
+        version = hashlib.sha1(json.dumps(sorted([ project['fingerprint'] for project in projects.values() ]))).hexdigest()
+        return PhETCatalog(all_links, version), projects
+
+LEVEL_AGE_RANGES = {
+    'university': ('>18',),
+    'high-school': ('14-16', '16-18'),
+    'middle-school': ('10-12', '12-14'),
+    'elementary-school': ('8-10', '6-8', '<6'),
+}
+
+def _build_metadata_by_id(categories, levels):
+    # Inverts the category tree and the levels into:
+    # {
+    #     simulation_id: ( [ domain1, domain2 ], [ age_range1, age_range2 ] )
+    # }
+    metadata_by_id = {}
+    for category_name, simulation_ids in categories.iteritems():
+        for simulation_id in set(simulation_ids):
+            metadata_by_id.setdefault(simulation_id, ([], []))[0].append(category_name)
+
+    for level_name, simulation_ids in levels.iteritems():
+        for simulation_id in set(simulation_ids):
+            metadata_by_id.setdefault(simulation_id, ([], []))[1].extend(LEVEL_AGE_RANGES[level_name])
+
+    return metadata_by_id
+
+def _set_project_metadata(project_links, domains, age_ranges):
+    for entry in project_links.values():
+        entry.domains = tuple(domains)
+        entry.age_ranges = tuple(age_ranges)
+
+def _build_project_links(simulation, strings = None):
+    # The domains and age ranges are set later by _set_project_metadata.
+    # strings is used to share equal strings (e.g., locale codes) among entries
+    if strings is None:
+        strings = {}
+
+    project_links = {}
+
+    for real_sim in simulation['simulations']:
+        link = "http://phet.colorado.edu/en/simulation/%s" % real_sim['name']
+
+        entry = PhETCatalogEntry(link, real_sim['description']['en'])
+        for localized_sim in real_sim['localizedSimulations']:
+            lang = localized_sim['locale']
+            if '_' not in lang:
+                lang = lang + "_ALL"
+
+            run_url = localized_sim['runUrl'].replace('https://', 'http://')
+            entry.add_locale(lang, localized_sim['title'], run_url, localized_sim['locale'], strings)
+
+            if lang == 'zh_CN':
+                entry.add_alias('zh_ALL', lang, strings)
+
+        # Repeat filling the spaces (e.g., xx_YY will also be xx_ALL). Only if needed
+        for localized_sim in real_sim['localizedSimulations']:
+            lang = localized_sim['locale']
+            if '_' not in lang:
+                # 'es' is already default, so no issue
+                continue
+
+            generalized_lang = lang.split('_')[0] + '_ALL'
+
+            if generalized_lang not in entry:
+                entry.add_alias(generalized_lang, lang, strings)
+
+        if entry.locales:
+            project_links[link] = entry
+
+    return project_links
+
+def _invalidate_changed_links(previous_state, all_links, projects):
+    previous_links = previous_state['all_links']
+    changed_links = set()
+    for link in set(previous_links.keys()).union(all_links.keys()):
+        previous_link_data = previous_links.get(link)
+        current_link_data = all_links.get(link)
+        if previous_link_data is not current_link_data and previous_link_data != current_link_data:
+            changed_links.add(link)
+
+    if not changed_links:
+        return
 
-                if generalized_lang not in sim_links['localized']:
-                    sim_links['localized'][generalized_lang] = {
-                        'link' : link,
-                        'name': localized_sim['title'],
-                        'run_url': localized_sim['runUrl'].replace('https://', 'http://'),
-                    }
+    dbg("Invalidating %s changed PhET laboratories" % len(changed_links))
 
-            if sim_links['localized']:
-                all_links[link] = sim_links
+    CACHE.invalidate('get_laboratories')
+    CACHE.invalidate('get_lab_url_index')
+    CACHE.invalidate('get_lab_query_index')
 
-    PHET.cache[KEY] = all_links
-    return all_links
+    # <lab>_<locale> keys are read by processes which do not have the catalog
+    # yet, so they are invalidated
+    all_languages = set(previous_links.languages).union(all_links.languages)
+
+    # The cache does not support deletions, but every reader treats None as a
+    # miss. Written in batches: PhET might have changed every simulation.
+    writer = _CacheWriter()
+    try:
+        for link in changed_links:
+            for language in all_languages:
+                writer.put('_'.join((link, language)), None)
+    finally:
+        writer.close()
 
 def fetch_children_recursively(phet_categories, node, results, max_depth):
     if max_depth == 0:
@@ -213,25 +1281,232 @@ def fetch_children_recursively(phet_categories, node, results, max_depth):
         results[current_children['name']] = current_children['simulationIds']
         fetch_children_recursively(phet_categories, current_children, results, max_depth - 1)
 
+def _entry_languages(catalog, laboratory_id):
+    entry = catalog.get(laboratory_id)
+    if entry is None:
+        return []
+    return entry.languages()
+
+class PhETLaboratories(list):
+    # The laboratories of the catalog with that version (see retrieve_labs)
+    def __init__(self, laboratories = (), version = None):
+        list.__init__(self, laboratories)
+        self.version = version
+
+class PhETLabUrlIndex(dict):
+    # Same, for the URL index (see build_lab_url_index)
+    def __init__(self, items = (), version = None):
+        dict.__init__(self, items)
+        self.version = version
+
+def _built_from(version):
+    # Values built from another version of the catalog (e.g., by a reader
+    # while it was being refreshed) are rebuilt
+    return lambda value: getattr(value, 'version', None) == version
+
 def retrieve_labs():
-    KEY = 'get_laboratories'
-    laboratories = PHET.cache.get(KEY, min_time = MIN_TIME)
-    if laboratories:
-        return laboratories
+    version = retrieve_all_links().version
+    return CACHE.get_or_compute('get_laboratories', _build_labs, valid = _built_from(version))
 
+def _build_labs():
     dbg("get_laboratories not in cache")
 
     links = retrieve_all_links()
-    laboratories = []
-    for link, link_data in links.iteritems():
-        if 'en_ALL' in link_data['localized']:
-            cur_name = link_data['localized']['en_ALL']['name']
-            lab = Laboratory(name = cur_name, laboratory_id = link, autoload = True, domains=link_data['metadata']['domains'], age_ranges=link_data['metadata']['age_ranges'], description=link_data['metadata']['description'])
+    laboratories = PhETLaboratories(version = links.version)
+    for link, entry in links.iteritems():
+        if 'en_ALL' in entry:
+            cur_name = entry.name('en_ALL')
+            lab = Laboratory(name = cur_name, laboratory_id = link, autoload = True, domains=list(entry.domains), age_ranges=list(entry.age_ranges), description=entry.description)
             laboratories.append(lab)
 
-    PHET.cache[KEY] = laboratories
+    CACHE.set('get_lab_url_index', build_lab_url_index(laboratories))
+    CACHE.set('get_lab_query_index', PhETLabQueryIndex(laboratories, links))
     return laboratories
 
+def build_lab_url_index(laboratories):
+    # 'acid-base-solutions' -> Laboratory(laboratory_id = 'http://phet.colorado.edu/en/simulation/acid-base-solutions')
+    return PhETLabUrlIndex([ (lab.laboratory_id.rsplit('/', 1)[-1], lab) for lab in laboratories ], getattr(laboratories, 'version', None))
+
+def _url_slug_candidates(url):
+    path = urlparse.urlparse(url).path
+    parts = path[1:].split('/')
+    if len(parts) > 2:
+        if parts[1] == 'simulation':
+            # /xx/simulation/legacy/<slug>
+            if parts[2] == 'legacy' and len(parts) > 3:
+                yield parts[3]
+            # /xx/simulation/<slug>
+            yield parts[2]
+        # /sims/html/<slug>/...
+        if parts[1] == 'html':
+            yield parts[2]
+        # /sims/<slug>/<slug>_xx.html or /sims/<project>/<slug>_xx.jnlp
+        if parts[0] == 'sims':
+            yield parts[1]
+            yield parts[2].split('_')[0]
+
+def find_lab_in_url_index(index, url):
+    for slug in _url_slug_candidates(url):
+        lab = index.get(slug)
+        if lab is not None:
+            return lab
+
+    return None
+
+def retrieve_lab_url_index():
+    # retrieve_labs() stores the index whenever it rebuilds the laboratories,
+    # so it is only computed here if the index expired on its own
+    version = retrieve_all_links().version
+    return CACHE.get_or_compute('get_lab_url_index', lambda : build_lab_url_index(retrieve_labs()), valid = _built_from(version))
+
+_TOKEN_REGEX = re.compile(r'\w+', re.UNICODE)
+
+def _tokenize(text):
+    if not text:
+        return []
+    return [ token.lower() for token in _TOKEN_REGEX.findall(text) ]
+
+class PhETLabQueryIndex(object):
+    # Inverted indexes on the laboratories for query_laboratories(). Each
+    # laboratory is represented by its position in laboratories, which is
+    # sorted by identifier, so results always come in the same order:
+    #
+    #   by_domain = { 'chemistry': frozenset([ 0, 5, ... ]) }
+    #   by_age_range = { '11-14': frozenset([ 3, 5, ... ]) }
+    #   by_language = { 'es_ALL': frozenset([ 0, 1, ... ]) }
+    #   by_token = { 'acid': frozenset([ 0 ]) }   (words of the name and the description)
+    #   tokens = [ 'acid', 'base', ... ]          (sorted, for prefix searches)
+    __slots__ = ('version', 'laboratories', 'by_domain', 'by_age_range', 'by_language', 'by_token', 'tokens')
+
+    def __init__(self, laboratories, catalog):
+        self.version = catalog.version
+        self.laboratories = sorted(laboratories, key = lambda lab: lab.laboratory_id)
+
+        positions = {}
+        by_domain = {}
+        by_age_range = {}
+        by_token = {}
+        for position, lab in enumerate(self.laboratories):
+            positions[lab.laboratory_id] = position
+            for domain in lab.domains or []:
+                by_domain.setdefault(domain, set()).add(position)
+            for age_range in lab.age_ranges or []:
+                by_age_range.setdefault(age_range, set()).add(position)
+            for token in _tokenize(lab.name) + _tokenize(lab.description):
+                by_token.setdefault(token, set()).add(position)
+
+        by_language = {}
+        for language in catalog.languages:
+            by_language[language] = [ positions[laboratory_id] for laboratory_id in catalog.laboratory_ids_in(language) if laboratory_id in positions ]
+
+        self.by_domain = self._freeze(by_domain)
+        self.by_age_range = self._freeze(by_age_range)
+        self.by_language = self._freeze(by_language)
+        self.by_token = self._freeze(by_token)
+        self.tokens = sorted(self.by_token)
+
+    def __repr__(self):
+        return 'PhETLabQueryIndex(%s laboratories, version=%r)' % (len(self.laboratories), self.version)
+
+    def __getstate__(self):
+        return dict([ (name, getattr(self, name)) for name in self.__slots__ ])
+
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, state[name])
+
+    @staticmethod
+    def _freeze(index):
+        return dict([ (value, frozenset(positions)) for value, positions in index.iteritems() ])
+
+    @staticmethod
+    def _union(index, values):
+        positions = set()
+        for value in values:
+            positions.update(index.get(value, ()))
+        return positions
+
+    def _token_positions(self, prefix):
+        # Laboratories with any word starting by prefix
+        positions = set()
+        for position in xrange(bisect.bisect_left(self.tokens, prefix), len(self.tokens)):
+            token = self.tokens[position]
+            if not token.startswith(prefix):
+                break
+            positions.update(self.by_token[token])
+        return positions
+
+    def _language_positions(self, language):
+        if '_' not in language:
+            language = language + '_ALL'
+        return self.by_language.get(language, frozenset())
+
+    def laboratories_in_language(self, language):
+        # Same as query(language = language)['laboratories'], without the facets
+        return [ self.laboratories[position] for position in sorted(self._language_positions(language)) ]
+
+    def query(self, domains = None, age_ranges = None, language = None, text = None, offset = 0, limit = None):
+        # Laboratories in any of the domains, in any of the age_ranges,
+        # available in language, and with all the words of text (as prefixes)
+        # in their name or description
+        candidates = []
+        if domains:
+            candidates.append(self._union(self.by_domain, domains))
+        if age_ranges:
+            candidates.append(self._union(self.by_age_range, age_ranges))
+        if language:
+            candidates.append(self._language_positions(language))
+        for token in _tokenize(text):
+            candidates.append(self._token_positions(token))
+
+        if candidates:
+            candidates.sort(key = len)
+            matches = set(candidates[0])
+            for positions in candidates[1:]:
+                if not matches:
+                    break
+                matches.intersection_update(positions)
+            matches = sorted(matches)
+        else:
+            matches = range(len(self.laboratories))
+
+        if limit is None:
+            page = matches[offset:]
+        else:
+            page = matches[offset:offset + limit]
+
+        return {
+            'version': self.version,
+            'total': len(matches),
+            'offset': offset,
+            'limit': limit,
+            'laboratories': [ self.laboratories[position] for position in page ],
+            'facets': self._facets(matches),
+        }
+
+    def _facets(self, matches):
+        # Number of matching laboratories per domain, age range and language
+        matches = frozenset(matches)
+        facets = {}
+        for name, index in (('domains', self.by_domain), ('age_ranges', self.by_age_range), ('languages', self.by_language)):
+            counts = {}
+            for value, positions in index.iteritems():
+                count = len(positions & matches)
+                if count:
+                    counts[value] = count
+            facets[name] = counts
+        return facets
+
+def retrieve_lab_query_index():
+    # Like the URL index, retrieve_labs() stores it whenever it rebuilds the laboratories
+    # An index built from another version of the catalog is rebuilt
+    version = retrieve_all_links().version
+    return CACHE.get_or_compute('get_lab_query_index', lambda : PhETLabQueryIndex(retrieve_labs(), retrieve_all_links()), valid = lambda index: isinstance(index, PhETLabQueryIndex) and index.version == version)
+
+def query_laboratories(domains = None, age_ranges = None, language = None, text = None, offset = 0, limit = None):
+    # { 'total': number of matches, 'laboratories': [ Laboratory, ... ] (the requested page), 'facets': {...} }
+    return retrieve_lab_query_index().query(domains = domains, age_ranges = age_ranges, language = language, text = text, offset = offset, limit = limit)
+
 CAPABILITIES = [ Capabilities.WIDGET, Capabilities.TRANSLATION_LIST, Capabilities.URL_FINDER, Capabilities.CHECK_URLS, Capabilities.DOWNLOAD_LIST ]
 
 class RLMS(BaseRLMS):
@@ -245,32 +1520,18 @@ class RLMS(BaseRLMS):
     def get_capabilities(self):
         return CAPABILITIES 
 
+    @timed('get_laboratories')
     def get_laboratories(self, **kwargs):
         return retrieve_labs()
 
+    def query_laboratories(self, domains = None, age_ranges = None, language = None, text = None, offset = 0, limit = None):
+        return query_laboratories(domains = domains, age_ranges = age_ranges, language = language, text = text, offset = offset, limit = limit)
+
     def get_base_urls(self):
         return [ 'http://phet.colorado.edu/', 'https://phet.colorado.edu/' ]
 
     def get_lab_by_url(self, url):
-        labs = { lab.laboratory_id.rsplit('/', 1)[-1]: lab for lab in retrieve_labs() }
-        path = urlparse.urlparse(url).path
-        parts = path[1:].split('/')
-        if len(parts) > 2:
-            if parts[1] == 'simulation':
-                if parts[2] == 'legacy' and len(parts) > 3:
-                    if parts[3] in labs.keys():
-                        return labs[parts[3]]
-                if parts[2] in labs.keys():
-                    return labs[parts[2]]
-            if parts[1] == 'html' and parts[2] in labs.keys():
-                return labs[parts[2]]
-            if parts[0] == 'sims':
-                if parts[1] in labs.keys():
-                    return labs[parts[1]]
-                if parts[2].split('_')[0] in labs.keys():
-                    return labs[parts[2].split('_')[0]]
-
-        return None
+        return find_lab_in_url_index(retrieve_lab_url_index(), url)
 
     def _convert_i18n_strings(self, strings):
         translations = {
@@ -281,41 +1542,41 @@ class RLMS(BaseRLMS):
             #      }
             # }
         }
+        translations.update(self._iter_converted_i18n_strings(strings))
+        return translations
+
+    def _iter_converted_i18n_strings(self, strings, consume = False):
+        # Yields (lang, converted strings) one language at a time. The namespace
+        # of each key is calculated once for all the languages. If consume is
+        # True, each language is removed from strings once converted, so the
+        # original and the converted strings are not both fully in memory.
+        namespaces = _build_namespace_index(strings)
+
         for lang in strings.keys():
-            translations[lang] = {}
-            for key, value in strings[lang].items():
-                if '/' in key:
-                    namespace, _ = key.split('/', 1)
+            if consume:
+                lang_strings = strings.pop(lang)
+            else:
+                lang_strings = strings[lang]
+
+            converted = {}
+            for key, value in lang_strings.iteritems():
+                namespace = namespaces[key]
+                if namespace is None:
+                    converted[key] = { 'value': value }
                 else:
-                    namespace = None
-                translations[lang][key] = {
-                    'value': value,
-                }
+                    converted[key] = { 'value': value, 'namespace': namespace }
 
-                if namespace is not None:
-                    translations[lang][key]['namespace'] = namespace
-
-        return translations
+            yield lang, converted
 
     def get_translation_list(self, laboratory_id):
-        KEY = 'languages_{}'.format(laboratory_id)
-        languages = PHET.cache.get(KEY)
-        if languages is None:
-            languages = []
-            links = retrieve_all_links()
-            link_data = links.get(laboratory_id)
-            if link_data is not None:
-                languages = list(link_data['localized'].keys())
-            PHET.cache[KEY] = languages
-
+        # Straight from the catalog: one key per laboratory would evict the
+        # shared entries (get_laboratories, ...) from the local cache
         return {
-            'supported_languages' : languages
+            'supported_languages' : _entry_languages(retrieve_all_links(), laboratory_id)
         }
 
+    @timed('get_translations')
     def get_translations(self, laboratory_id):
-        translations = PHET.cache.get(laboratory_id)
-        if translations:
-            return translations
         RESPONSE = {
             'mails' : [
                 # TODO: hardcoded
@@ -324,111 +1585,119 @@ class RLMS(BaseRLMS):
             'translations' : {}
         }
 
-        try:            
-            data = self.reserve(laboratory_id, None, None, None, None, None, None)
-            url = data['load_url']
-            
-            name = url.split('/')[-3]
-            string_map_url = url.rsplit('/', 1)[0] + '/' + name + '_string-map.json'
-            r = PHET.cached_session.get(string_map_url)
-            if r.status_code == 200:
-                try:
-                    converted_strings = self._convert_i18n_strings(r.json())
-                except:
-                    traceback.print_exc()
-                else:
-                    RESPONSE['translations'].update(converted_strings)
-                    return RESPONSE
-
-            r = PHET.cached_session.get(url)
-            if r.status_code != 200:
-                return RESPONSE
-
-            i18n_line = None
-            for line in r.text.splitlines():
-                if line.strip().startswith('window.phet.chipper.strings'):
-                    i18n_line = line
-                    break
+        try:
+            RESPONSE['translations'].update(self._retrieve_translations(laboratory_id))
+        except:
+            traceback.print_exc()
 
-            if i18n_line is None:
-                return RESPONSE
+        return RESPONSE
+
+    def _retrieve_translations(self, laboratory_id):
+        # The converted strings are stored as translations_<lab>_<version>, where
+        # version depends on the contents (ETag or hash of the document), and
+        # translations_state_<lab> points to the current version. After MIN_TIME
+        # the document is requested again with If-None-Match / If-Modified-Since.
+        # These requests do not go through PHET.cached_session: the conditional
+        # requests replace its HTTP caching, and the documents are not stored twice.
+        STATE_KEY = 'translations_state_{}'.format(laboratory_id)
+        state = CACHE.shared.get(STATE_KEY)
+        if state and time.time() - state['checked'] < MIN_TIME.total_seconds():
+            translations = CACHE.shared.get(_translations_key(laboratory_id, state['version']))
+            if translations is not None:
+                return translations
+
+        url = self._get_url(laboratory_id, 'en_ALL')['load_url']
+        name = url.split('/')[-3]
+        string_map_url = url.rsplit('/', 1)[0] + '/' + name + '_string-map.json'
+
+        # The simulation HTML is several MB, so it is streamed and only read up to the strings
+        for source_url, parse, stream in ((string_map_url, _parse_string_map, False), (url, _parse_chipper_strings, True)):
+            headers = {}
+            if state and state['url'] == source_url:
+                if state.get('etag'):
+                    headers['If-None-Match'] = state['etag']
+                if state.get('last_modified'):
+                    headers['If-Modified-Since'] = state['last_modified']
+
+            r = HTTP.get(source_url, headers = headers, stream = stream)
+            if r.status_code == 304:
+                r.close()
+                translations = CACHE.shared.get(_translations_key(laboratory_id, state['version']))
+                if translations is not None:
+                    CACHE.shared[STATE_KEY] = dict(state, checked = time.time())
+                    return translations
+                r = HTTP.get(source_url, stream = stream)
 
-            json_contents = i18n_line.split('=', 1)[1].strip()
-            json_contents = json_contents.rsplit(';', 1)[0]
             try:
-                contents = json.loads(json_contents)
+                if r.status_code != 200:
+                    continue
+
+                strings = parse(r)
             except:
-                return RESPONSE
+                traceback.print_exc()
+                continue
+            finally:
+                r.close()
+
+            if strings is None:
+                continue
+
+            etag = r.headers.get('ETag')
+            version = hashlib.sha1(etag or json.dumps(strings, sort_keys = True)).hexdigest()
+            translations = dict(self._iter_converted_i18n_strings(strings, consume = True))
+            CACHE.shared[_translations_key(laboratory_id, version)] = translations
+            CACHE.shared[STATE_KEY] = {
+                'url': source_url,
+                'etag': etag,
+                'last_modified': r.headers.get('Last-Modified'),
+                'version': version,
+                'checked': time.time(),
+            }
+            return translations
 
-            return RESPONSE
-        except:
-            traceback.print_exc()
-            return RESPONSE
+        return {}
     
     def get_check_urls(self, laboratory_id):
-        check_urls = []
-        for locale in self.get_translation_list(laboratory_id)['supported_languages']:
-            response = self._get_url(laboratory_id, locale)
-            if response:
-                load_url = response['load_url']
-                check_urls.append(load_url)
-
-        return check_urls
+        return list(_get_locale_table().check_urls.get(laboratory_id, []))
 
     def get_downloads(self, laboratory_id):
-        downloads = {}
-        for locale in self.get_translation_list(laboratory_id)['supported_languages']:
-            response = self._get_url(laboratory_id, locale)
-            if response:
-                load_url = response['load_url'] + '?download'
-                downloads[locale] = load_url
+        return _mirrored_downloads(_get_locale_table().downloads.get(laboratory_id, {}))
+
+    def get_all_check_urls(self):
+        # { laboratory_id: [ url1, url2 ] } for every laboratory (e.g., for checking them all)
+        return dict([ (laboratory_id, list(check_urls)) for laboratory_id, check_urls in _get_locale_table().check_urls.iteritems() ])
+
+    def check_urls(self, laboratory_id = None):
+        # { url: result } for the laboratory, or for every laboratory (see check_urls)
+        if laboratory_id is None:
+            return check_urls()
+        return check_urls(self.get_check_urls(laboratory_id))
 
-        return downloads
+    def get_all_downloads(self):
+        return dict([ (laboratory_id, _mirrored_downloads(downloads)) for laboratory_id, downloads in _get_locale_table().downloads.iteritems() ])
 
+    @timed('_get_url')
     def _get_url(self, laboratory_id, locale):
         KEY = '_'.join((laboratory_id, locale))
-        response = PHET.cache.get(KEY, min_time = MIN_TIME)
-        if response is not None:
-            return response
+        table = _LOCALE_TABLE.get()
+        if table is None:
+            if _LOCALE_TABLE.building():
+                response = CACHE.shared.get(KEY, min_time = MIN_TIME)
+                if response is not None:
+                    METRICS.cache_access(KEY, hit = True)
+                    return response
 
-        dbg_current = functools.partial(dbg_lowlevel, scope = '%s::%s' % (laboratory_id, locale))
-        dbg_current("Retrieving links")
-        links = retrieve_all_links()
-        dbg_current("Links retrieved")
-        link_data = links.get(laboratory_id)
+            METRICS.cache_access(KEY, hit = False)
 
-        if link_data is None:
-            raise LabNotFoundError("Lab %s not found" % laboratory_id)
-
-        localized = link_data['localized'].get(locale)
-        if localized is None:
-            new_locale = locale.split('_')[0] + '_ALL'
-            NEW_KEY = '_'.join((laboratory_id, new_locale))
-            response = PHET.cache.get(NEW_KEY, min_time = MIN_TIME)
-            if response:
-                PHET.cache[KEY] = response
-                return response
-
-            localized = link_data['localized'].get(new_locale)
-            if localized is None:
-                NEW_KEY = '_'.join((laboratory_id, 'en_ALL'))
-                response = PHET.cache.get(NEW_KEY, min_time = MIN_TIME)
-                if response:
-                    PHET.cache[KEY] = response
-                    return response
+            dbg_lowlevel("Building locale fallback table", scope = '%s::%s' % (laboratory_id, locale))
+            table = _LOCALE_TABLE.build()
 
-                localized = link_data['localized']['en_ALL']
- 
-        url = localized['run_url']
+        else:
+            METRICS.cache_access(KEY, hit = True)
 
-        response = {
-            'reservation_id' : url,
-            'load_url' : url.replace('http://', 'https://')
-        }
-        dbg_current("Storing in cache")
-        PHET.cache[KEY] = response
-        return response
+        return table.lookup(laboratory_id, locale)
 
+    @timed('reserve')
     def reserve(self, laboratory_id, username, institution, general_configuration_str, particular_configurations, request_payload, user_properties, *args, **kwargs):
         locale = kwargs.get('locale', 'en_ALL')
         if '_' not in locale:
@@ -441,104 +1710,336 @@ class RLMS(BaseRLMS):
         return response
 
     def load_widget(self, reservation_id, widget_name, **kwargs):
+        url = reservation_id.replace('http://', 'https://')
+        if MIRROR is not None:
+            url = MIRROR.local_url(url) or url
         return {
-            'url' : reservation_id.replace('http://', 'https://')
+            'url' : url
         }
 
     def list_widgets(self, laboratory_id, **kwargs):
         default_widget = dict( name = 'default', description = 'Default widget' )
         return [ default_widget ]
 
-class _QueueTaskProcessor(threading.Thread):
-    def __init__(self, number, queue):
-        threading.Thread.__init__(self)
-        self.number = number
-        self.setName("QueueProcessor-%s" % number)
-        self.queue = queue
-        self._current = None
-
-    def run(self):
-        cache_disabler = CacheDisabler()
-        cache_disabler.disable()
-        try:
-            while True:
-                try:
-                    t = self.queue.get_nowait()
-                except Queue.Empty:
-                    break
-                else:
-                    self._current = t
-                    try:
-                        t.run()
-                    except:
-                        print("Error in task: %s" % t)
-                        traceback.print_exc()
-        finally:
-            cache_disabler.reenable()
-        self._current = None
+class TaskCancelledError(Exception):
+    pass
+
+class TaskTimeoutError(Exception):
+    pass
+
+# Threads waiting for tasks sleep in growing slices of up to this many seconds:
+# in Python 2, waiting on a lock without a timeout can not be interrupted by
+# signals such as SIGINT, and waiting with a timeout polls the lock every few
+# milliseconds
+TASK_WAIT_SLICE = 1
+
+def _sleep_until(predicate):
+    delay = 0.005
+    while not predicate():
+        time.sleep(delay)
+        delay = min(delay * 2, TASK_WAIT_SLICE)
+
+class _TaskFuture(object):
+    def __init__(self, task, timeout = None):
+        self.task = task
+        self.timeout = timeout
+        self.started = None
+        self.deadline = None
+        self._lock = threading.Lock()
+        self._finished = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
 
-        dbg("%s: finished" % self.name)
+    def __repr__(self):
+        return '_TaskFuture(task=%r, started=%r, finished=%r)' % (self.task, self.started, self._finished)
+
+    def done(self):
+        return self._finished
+
+    def cancelled(self):
+        return isinstance(self._exception, TaskCancelledError)
+
+    def cancel(self):
+        # Tasks which did not start are never run. Running tasks are asked to stop()
+        with self._lock:
+            if self._finished:
+                return False
+            not_started = self.started is None
+            if not_started:
+                self.started = time.time()
+
+        if not_started:
+            return self._finish(None, TaskCancelledError("%r cancelled" % self.task))
+
+        stop = getattr(self.task, 'stop', None)
+        if stop is not None:
+            stop()
+        return False
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._finished:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def exception(self):
+        _sleep_until(self.done)
+        return self._exception
+
+    def result(self):
+        exception = self.exception()
+        if exception is not None:
+            raise exception
+        return self._result
+
+    def _start(self):
+        # Returns False if the task must not be run (e.g., it was cancelled)
+        with self._lock:
+            if self._finished or self.started is not None:
+                return False
+            self.started = time.time()
+            if self.timeout is not None:
+                self.deadline = self.started + self.timeout
+        return True
+
+    def _expire(self):
+        if self._finish(None, TaskTimeoutError("%r did not finish in %s seconds" % (self.task, self.timeout))):
+            # The thread can not be killed, but the task can stop cooperatively
+            stop = getattr(self.task, 'stop', None)
+            if stop is not None:
+                stop()
+
+    def _finish(self, result, exception):
+        with self._lock:
+            if self._finished:
+                return False
+            self._result = result
+            self._exception = exception
+            self._finished = True
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except:
+                traceback.print_exc()
+        return True
+
+class _TaskEngine(object):
+    # Runs task objects (anything with a run() method, and optionally a stop()
+    # method) in a bounded pool of threads. submit() blocks while the queue is
+    # full, and returns a _TaskFuture which can be waited for, cancelled or
+    # observed through callbacks. Timeouts are enforced by a single watchdog
+    # thread per engine, started with the first task which has one.
+    def __init__(self, threads = None, queue_size = None, task_timeout = None, name = 'TaskEngine'):
+        self.threads = threads or NUM_THREADS
+        self.task_timeout = task_timeout
+        self.name = name
+        self._queue = Queue.Queue(maxsize = queue_size or 2 * self.threads)
+        self._lock = threading.Lock()
+        self._workers = []
+        self._pending = set()
+        self._cancelled = False
+        self._shutdown = False
+        # [ (deadline, future) ] heap of the running tasks with a timeout
+        self._deadlines = []
+        self._watchdog = None
+        self._watchdog_condition = threading.Condition()
 
     def __repr__(self):
-        return "_QueueTaskProcessor(number=%r, current=%r; alive=%r)" % (self.number, self._current, self.isAlive())
+        return '_TaskEngine(name=%r, threads=%r, pending=%r)' % (self.name, self.threads, len(self._pending))
+
+    def submit(self, task, timeout = None):
+        if self._cancelled or self._shutdown:
+            raise TaskCancelledError("%r does not accept new tasks" % self)
+
+        if timeout is None:
+            timeout = self.task_timeout
+
+        future = _TaskFuture(task, timeout)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._discard)
+
+        self._start_workers()
+        if not self._put(future, cancellable = True):
+            future.cancel()
+            raise TaskCancelledError("%r does not accept new tasks" % self)
+        return future
+
+    def _put(self, item, cancellable = False):
+        # Returns False if the engine was cancelled while the queue was full
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return True
+            except Queue.Full:
+                if cancellable and self._cancelled:
+                    return False
+                _sleep_until(lambda : (cancellable and self._cancelled) or not self._queue.full())
+
+    def wait(self, futures):
+        # Blocks until every future is finished
+        for future in futures:
+            future.exception()
+
+    def cancel(self):
+        self._cancelled = True
+        with self._lock:
+            pending = list(self._pending)
+
+        for future in pending:
+            future.cancel()
+
+    def shutdown(self, wait = True):
+        self._shutdown = True
+        with self._lock:
+            workers = list(self._workers)
+
+        for _ in workers:
+            self._put(None)
+
+        if wait:
+            for worker in workers:
+                _sleep_until(lambda : not worker.is_alive())
+
+            # Every task finished: the watchdog has nothing else to wait for
+            with self._watchdog_condition:
+                watchdog = self._watchdog
+                self._watchdog_condition.notify()
+            if watchdog is not None:
+                _sleep_until(lambda : not watchdog.is_alive())
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._workers) < self.threads:
+                worker = threading.Thread(target = self._work, name = '%s-%s' % (self.name, len(self._workers)))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _watch_deadline(self, future):
+        with self._watchdog_condition:
+            heapq.heappush(self._deadlines, (future.deadline, future))
+            if self._watchdog is None:
+                self._watchdog = threading.Thread(target = self._watch, name = '%s-watchdog' % self.name)
+                self._watchdog.daemon = True
+                self._watchdog.start()
+            self._watchdog_condition.notify()
+
+    def _watch(self):
+        # Expires the running tasks whose deadline passed. Without deadlines,
+        # it waits until there is one. After shutdown(), it only waits for the
+        # tasks still running.
+        while True:
+            expired = []
+            with self._watchdog_condition:
+                now = time.time()
+                while self._deadlines and (self._deadlines[0][0] <= now or self._deadlines[0][1].done()):
+                    _, future = heapq.heappop(self._deadlines)
+                    if not future.done():
+                        expired.append(future)
+
+                if not expired:
+                    if self._shutdown and not self._deadlines:
+                        break
+
+                    if self._deadlines:
+                        self._watchdog_condition.wait(self._deadlines[0][0] - now)
+                    else:
+                        self._watchdog_condition.wait()
+
+            for future in expired:
+                future._expire()
+
+    def _work(self):
+        while True:
+            future = self._queue.get()
+            if future is None:
+                break
+
+            if not future._start():
+                continue
+
+            if future.deadline is not None:
+                self._watch_deadline(future)
+
+            try:
+                result = future.task.run()
+            except Exception as e:
+                print("Error in task: %s" % future.task)
+                traceback.print_exc()
+                future._finish(None, e)
+            else:
+                future._finish(result, None)
+
+        dbg("%s: finished" % threading.current_thread().name)
 
 NUM_THREADS = 32
 if os.environ.get('G4L_PHET_THREADS'):
     NUM_THREADS = int(os.environ['G4L_PHET_THREADS'])
 
-def _run_tasks(tasks, threads = NUM_THREADS):
-    queue = Queue.Queue()
-    for task in tasks:
-        queue.put(task)
-    
-    task_processors = []
-    for task_processor_number in range(threads):
-        task_processor = _QueueTaskProcessor(task_processor_number, queue)
-        task_processor.start()
-        task_processors.append(task_processor)
-
-    any_alive = True
-    count = 0
-    while any_alive:
-        alive_threads = []
-        for task_processor in task_processors:
-            if task_processor.isAlive():
-                alive_threads.append(task_processor)
-
-        any_alive = len(alive_threads) > 0
-
-        if any_alive:
-            count = count + 1
-            if count % 60 == 0:
-                if len(alive_threads) > 5:
-                    dbg("%s live processors" % len(alive_threads))
-                    print("[%s] %s live processors" % (time.asctime(), len(alive_threads)))
-                else:
-                    dbg("%s live processors: %s" % (len(alive_threads), ', '.join([ repr(t) for t in alive_threads ])))
-                    print("[%s] %s live processors: %s" % (time.asctime(), len(alive_threads), ', '.join([ repr(t) for t in alive_threads ])))
-                sys.stdout.flush()
-
-        try:
-            time.sleep(1)
-        except:
-            # If there is an exception (such as keyboardinterrupt, or kill process..)
-            for task in tasks:
-                task.stop()
-
-            # Delete everything in the queue (so the task stops) and re-raise the exception
-            while True:
-                try:
-                    queue.get_nowait()
-                except Queue.Empty:
-                    break
-            raise
+class _TaskProgress(object):
+    # Completion callback which reports the progress at most every REPORT_EVERY seconds
+    REPORT_EVERY = 60
+
+    def __init__(self, total):
+        self.total = total
+        self.finished = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._last_report = time.time()
+
+    def task_done(self, future):
+        with self._lock:
+            self.finished += 1
+            if future.exception() is not None:
+                self.failed += 1
+
+            now = time.time()
+            if now - self._last_report < self.REPORT_EVERY:
+                return
+            self._last_report = now
+            message = "%s/%s tasks finished (%s failed)" % (self.finished, self.total, self.failed)
+
+        dbg(message)
+        print("[%s] %s" % (time.asctime(), message))
+        sys.stdout.flush()
 
+def _run_tasks(tasks, threads = NUM_THREADS, task_timeout = None):
+    engine = _TaskEngine(threads = threads, task_timeout = task_timeout, name = 'QueueProcessor')
+    progress = _TaskProgress(len(tasks))
+    try:
+        futures = []
+        for task in tasks:
+            future = engine.submit(task)
+            future.add_done_callback(progress.task_done)
+            futures.append(future)
+
+        engine.wait(futures)
+    except:
+        # If there is an exception (such as keyboardinterrupt, or kill process..)
+        # cancel the pending tasks, stop the running ones and re-raise the exception
+        engine.cancel()
+        engine.shutdown(wait = False)
+        raise
+
+    engine.shutdown()
     dbg("All processes are over")
+    return futures
 
 class _QueueTask(object):
-    def __init__(self, laboratory_id, language):
+    def __init__(self, laboratory_id, language, lease = None):
         self.laboratory_id = laboratory_id
         self.language = language
+        self.lease = lease
         self.stopping = False
 
     def __repr__(self):
@@ -548,36 +2049,897 @@ class _QueueTask(object):
         self.stopping = True
 
     def run(self):
-        if self.stopping:
+        if self.stopping or (self.lease is not None and self.lease.lost):
             return
 
         rlms = RLMS("{}")
         dbg(' - %s: %s lang: %s' % (threading.current_thread().name, self.laboratory_id, self.language))
-        rlms.reserve(self.laboratory_id, 'tester', 'foo', '', '', '', '', locale = self.language)
+        # Only these tasks: the rest (e.g., the translations harvest) read the cache
+        with CacheDisabler():
+            response = rlms.reserve(self.laboratory_id, 'tester', 'foo', '', '', '', '', locale = self.language)
+        # Warm start for other processes (see _LocaleFallbackTableHolder)
+        CACHE.shared['_'.join((self.laboratory_id, self.language))] = response
+
+def _build_namespace_index(strings):
+    # { key: namespace or None }, for the keys of all the languages. Equal
+    # namespaces share the same string.
+    namespaces = {}
+    namespace_strings = {}
+    for lang_strings in strings.itervalues():
+        for key in lang_strings:
+            if key in namespaces:
+                continue
+
+            if '/' in key:
+                namespace = key.split('/', 1)[0]
+                namespaces[key] = namespace_strings.setdefault(namespace, namespace)
+            else:
+                namespaces[key] = None
+    return namespaces
+
+def _translations_key(laboratory_id, version):
+    return 'translations_{}_{}'.format(laboratory_id, version)
+
+def _parse_string_map(r):
+    return r.json()
+
+CHIPPER_CHUNK_SIZE = 64 * 1024
+
+def _parse_chipper_strings(r):
+    # The simulation HTML contains a line such as:
+    # window.phet.chipper.strings = {"en":{"key":"value"}, "es": {...}};
+    # r is a streamed response: it is read line by line, and the rest of the
+    # document is never downloaded once the line is found (the caller closes r)
+    i18n_line = None
+    for line in r.iter_lines(chunk_size = CHIPPER_CHUNK_SIZE):
+        if line.strip().startswith('window.phet.chipper.strings'):
+            i18n_line = line
+            break
+
+    if i18n_line is None:
+        return None
+
+    json_contents = i18n_line.split('=', 1)[1].strip()
+    json_contents = json_contents.rsplit(';', 1)[0]
+    return json.loads(json_contents)
+
+TRANSLATION_THREADS = 8
+if os.environ.get('G4L_PHET_TRANSLATION_THREADS'):
+    TRANSLATION_THREADS = int(os.environ['G4L_PHET_TRANSLATION_THREADS'])
+
+class _TranslationTask(object):
+    def __init__(self, laboratory_id):
+        self.laboratory_id = laboratory_id
+        self.stopping = False
+
+    def __repr__(self):
+        return '_TranslationTask(laboratory_id=%r, stopping=%r)' % (self.laboratory_id, self.stopping)
+
+    def stop(self):
+        self.stopping = True
+
+    def run(self):
+        if self.stopping:
+            return None
+
+        translations = RLMS("{}")._retrieve_translations(self.laboratory_id)
+        return len(translations)
+
+def harvest_translations(laboratory_ids = None, threads = None):
+    # Retrieves (and stores in the cache) the translations of many laboratories
+    # concurrently. Returns { laboratory_id: number of languages, or None if it failed }
+    if laboratory_ids is None:
+        laboratory_ids = [ lab.laboratory_id for lab in retrieve_labs() ]
+
+    tasks = [ _TranslationTask(laboratory_id) for laboratory_id in laboratory_ids ]
+    futures = _run_tasks(tasks, threads = threads or TRANSLATION_THREADS)
+
+    results = {}
+    for future in futures:
+        if future.exception() is None:
+            results[future.task.laboratory_id] = future.result()
+        else:
+            results[future.task.laboratory_id] = None
+    return results
+
+URL_CHECK_THREADS = 16
+if os.environ.get('G4L_PHET_CHECK_THREADS'):
+    URL_CHECK_THREADS = int(os.environ['G4L_PHET_CHECK_THREADS'])
+
+# Maximum number of requests per second to the same host
+URL_CHECK_RATE = float(os.environ.get('G4L_PHET_CHECK_RATE') or 10)
+
+class _HostRateLimiter(object):
+    # Spaces the requests to the same host at least 1 / rate seconds, whatever
+    # the number of threads
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    def wait(self, url):
+        if not self.interval:
+            return
+
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+def _check_url_key(url):
+    return 'check_url_{}'.format(url)
+
+class _UrlCheckTask(object):
+    def __init__(self, url, previous, rate_limiter):
+        self.url = url
+        self.previous = previous
+        self.rate_limiter = rate_limiter
+        self.stopping = False
+
+    def __repr__(self):
+        return '_UrlCheckTask(url=%r, stopping=%r)' % (self.url, self.stopping)
+
+    def stop(self):
+        self.stopping = True
+
+    def _request(self, method, headers):
+        self.rate_limiter.wait(self.url)
+        if method == 'HEAD':
+            return HTTP.head(self.url, headers = headers, retries = 0)
+        return HTTP.get(self.url, headers = headers, stream = True, retries = 0)
+
+    def run(self):
+        if self.stopping:
+            return None
+
+        # If the URL was checked before, the check is conditional: a 304 means
+        # that it did not change and keeps the previous status
+        headers = {}
+        if self.previous and self.previous['ok']:
+            if self.previous.get('etag'):
+                headers['If-None-Match'] = self.previous['etag']
+            if self.previous.get('last_modified'):
+                headers['If-Modified-Since'] = self.previous['last_modified']
+
+        result = {
+            'url': self.url,
+            'status': None,
+            'ok': False,
+            'latency': None,
+            'error': None,
+            'etag': None,
+            'last_modified': None,
+            'checked': time.time(),
+            'cached': False,
+        }
+
+        t0 = time.time()
+        try:
+            r = self._request('HEAD', headers)
+            if r.status_code in (405, 501):
+                # Some servers do not support HEAD; only the headers are read
+                r.close()
+                r = self._request('GET', headers)
+            r.close()
+        except Exception as e:
+            result['latency'] = time.time() - t0
+            result['error'] = '%s: %s' % (type(e).__name__, e)
+        else:
+            result['latency'] = time.time() - t0
+            if r.status_code == 304 and self.previous:
+                result['status'] = self.previous['status']
+                result['etag'] = self.previous.get('etag')
+                result['last_modified'] = self.previous.get('last_modified')
+            else:
+                result['status'] = r.status_code
+                result['etag'] = r.headers.get('ETag')
+                result['last_modified'] = r.headers.get('Last-Modified')
+            result['ok'] = result['status'] is not None and result['status'] < 400
+
+        CACHE.shared[_check_url_key(self.url)] = result
+        return result
+
+def check_urls(urls = None, threads = None, rate = None, force = False):
+    # Checks many URLs concurrently (by default, the check URLs of every
+    # laboratory) and returns { url: result }, where result contains 'status'
+    # (None if the request failed), 'ok', 'latency' (seconds), 'error' and
+    # 'cached' (True if it was checked recently and no request was sent).
+    if urls is None:
+        urls = set()
+        for laboratory_urls in _get_locale_table().check_urls.itervalues():
+            urls.update(laboratory_urls)
+
+    results = {}
+    tasks = []
+    rate_limiter = _HostRateLimiter(URL_CHECK_RATE if rate is None else rate)
+    for url in sorted(set(urls)):
+        previous = CACHE.shared.get(_check_url_key(url))
+        if not force and previous is not None and previous['ok'] and time.time() - previous['checked'] < CACHE.ttl(_check_url_key(url)).total_seconds():
+            results[url] = dict(previous, cached = True)
+        else:
+            tasks.append(_UrlCheckTask(url, previous, rate_limiter))
+
+    if tasks:
+        for future in _run_tasks(tasks, threads = threads or URL_CHECK_THREADS):
+            if future.exception() is None and future.result() is not None:
+                results[future.task.url] = future.result()
+    return results
+
+# Local mirror of the simulation HTML files (which are self-contained). It is
+# filled by mirror_downloads() in G4L_PHET_MIRROR_PATH; if G4L_PHET_MIRROR_URL
+# (the URL where that directory is served) is also set, get_downloads and
+# load_widget return the mirrored copies.
+MIRROR_PATH = os.environ.get('G4L_PHET_MIRROR_PATH') or None
+MIRROR_URL = os.environ.get('G4L_PHET_MIRROR_URL') or None
+if MIRROR_URL and not MIRROR_URL.endswith('/'):
+    MIRROR_URL = MIRROR_URL + '/'
+
+MIRROR_THREADS = 8
+if os.environ.get('G4L_PHET_MIRROR_THREADS'):
+    MIRROR_THREADS = int(os.environ['G4L_PHET_MIRROR_THREADS'])
+
+MIRROR_CHUNK_SIZE = 64 * 1024
+
+def _mirror_key(url):
+    # 'http://phet.colorado.edu/sims/.../sim_es.html?download' -> 'https://phet.colorado.edu/sims/.../sim_es.html'
+    return url.split('?', 1)[0].replace('http://', 'https://')
+
+class _SimMirror(object):
+    # Content-addressed store:
+    #
+    #   objects/<sha256[:2]>/<sha256>.html   one file per different content, so
+    #                                         URLs with the same file share it
+    #   partial/<sha1(url)>.part             downloads in progress, resumed with
+    #   partial/<sha1(url)>.json             a Range request (and If-Range: <etag>)
+    #   index.json                           { url: { 'digest', 'size', 'etag', 'last_modified', 'mirrored' } }
+    def __init__(self, root, base_url = None):
+        self.root = root
+        self.base_url = base_url
+        self.objects_dir = os.path.join(root, 'objects')
+        self.partial_dir = os.path.join(root, 'partial')
+        self.index_path = os.path.join(root, 'index.json')
+        self._lock = threading.Lock()
+        self._index = {}
+        self._index_mtime = None
+
+    def __repr__(self):
+        return '_SimMirror(root=%r, base_url=%r)' % (self.root, self.base_url)
+
+    def _merge_saved_index(self):
+        # Adds what other processes saved to the index, keeping the entries
+        # mirrored here which are newer (e.g., fetched but not saved yet).
+        # Must be called with the lock.
+        try:
+            mtime = os.path.getmtime(self.index_path)
+            with open(self.index_path) as f:
+                saved = json.load(f)
+        except (OSError, IOError):
+            return
+        except ValueError:
+            traceback.print_exc()
+            return
+
+        index = dict(self._index)
+        for url, entry in saved.iteritems():
+            current = index.get(url)
+            if current is None or entry['mirrored'] > current['mirrored']:
+                index[url] = entry
+        self._index = index
+        self._index_mtime = mtime
+
+    def index(self):
+        # The index is merged again if another process saved a new one
+        try:
+            mtime = os.path.getmtime(self.index_path)
+        except OSError:
+            return self._index
+
+        if mtime != self._index_mtime:
+            with self._lock:
+                if mtime != self._index_mtime:
+                    self._merge_saved_index()
+        return self._index
+
+    def save_index(self):
+        with self._lock:
+            self._merge_saved_index()
+            index = dict(self._index)
+
+            tmp_path = '%s.%s.tmp' % (self.index_path, _process_id())
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.rename(tmp_path, self.index_path)
+            self._index_mtime = os.path.getmtime(self.index_path)
+
+    def _relative_path(self, digest):
+        return 'objects/%s/%s.html' % (digest[:2], digest)
+
+    def object_path(self, digest):
+        return os.path.join(self.root, *self._relative_path(digest).split('/'))
+
+    def local_url(self, url, index = None):
+        # URL of the mirrored copy of url, or None
+        if not self.base_url:
+            return None
+
+        entry = (index or self.index()).get(_mirror_key(url))
+        if entry is None:
+            return None
+        return self.base_url + self._relative_path(entry['digest'])
+
+    def fetch(self, url, force = False):
+        # Downloads url (if it changed) into the store and returns its entry
+        url = _mirror_key(url)
+        entry = None if force else self.index().get(url)
+        if entry is not None and not os.path.exists(self.object_path(entry['digest'])):
+            entry = None
+
+        url_hash = hashlib.sha1(url).hexdigest()
+        part_path = os.path.join(self.partial_dir, url_hash + '.part')
+        meta_path = os.path.join(self.partial_dir, url_hash + '.json')
+
+        headers = {}
+        offset = 0
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        elif os.path.exists(part_path) and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get('etag'):
+                offset = os.path.getsize(part_path)
+                headers['Range'] = 'bytes=%s-' % offset
+                headers['If-Range'] = meta['etag']
+
+        downloaded = 0
+        r = HTTP.get(url, headers = headers, stream = True)
+        try:
+            if r.status_code == 304 and entry is not None:
+                return dict(entry, url = url, status = 304, downloaded = 0)
+
+            if r.status_code == 416 and offset:
+                # The part is already complete (e.g., the process died before
+                # moving it), or longer than the file: from the beginning
+                r.close()
+                os.remove(part_path)
+                os.remove(meta_path)
+                return self.fetch(url, force = force)
+
+            if r.status_code not in (200, 206):
+                return { 'url': url, 'status': r.status_code, 'downloaded': 0 }
+
+            if r.status_code == 200:
+                # Not resumed (or the file changed meanwhile): from the beginning
+                offset = 0
+                meta = { 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified') }
+                if not os.path.exists(self.partial_dir):
+                    try:
+                        os.makedirs(self.partial_dir)
+                    except OSError:
+                        pass
+                with open(meta_path, 'w') as f:
+                    json.dump(meta, f)
+
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                for chunk in r.iter_content(MIRROR_CHUNK_SIZE):
+                    f.write(chunk)
+                    downloaded += len(chunk)
+        finally:
+            r.close()
+
+        digest = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda : f.read(MIRROR_CHUNK_SIZE), ''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+
+        object_path = self.object_path(digest)
+        if os.path.exists(object_path):
+            # Same contents as another URL (or as before)
+            os.remove(part_path)
+        else:
+            if not os.path.exists(os.path.dirname(object_path)):
+                try:
+                    os.makedirs(os.path.dirname(object_path))
+                except OSError:
+                    pass
+            os.rename(part_path, object_path)
+        os.remove(meta_path)
+
+        entry = {
+            'digest': digest,
+            'size': os.path.getsize(object_path),
+            'etag': meta.get('etag'),
+            'last_modified': meta.get('last_modified'),
+            'mirrored': time.time(),
+        }
+        with self._lock:
+            self._index[url] = entry
+        return dict(entry, url = url, status = r.status_code, downloaded = downloaded)
+
+MIRROR = _SimMirror(MIRROR_PATH, MIRROR_URL) if MIRROR_PATH else None
+
+def _mirrored_downloads(downloads):
+    # { locale: download URL }, with the mirrored copies when there are
+    if MIRROR is None or not MIRROR.base_url:
+        return dict(downloads)
+
+    index = MIRROR.index()
+    return dict([ (locale, MIRROR.local_url(url, index) or url) for locale, url in downloads.iteritems() ])
+
+class _MirrorTask(object):
+    def __init__(self, mirror, url, force = False):
+        self.mirror = mirror
+        self.url = url
+        self.force = force
+        self.stopping = False
+
+    def __repr__(self):
+        return '_MirrorTask(url=%r, stopping=%r)' % (self.url, self.stopping)
+
+    def stop(self):
+        self.stopping = True
+
+    def run(self):
+        if self.stopping:
+            return None
+        return self.mirror.fetch(self.url, force = self.force)
+
+def mirror_downloads(laboratory_ids = None, locales = None, threads = None, force = False):
+    # Downloads the simulation HTML files of the laboratories (default: all)
+    # in the locales (default: all) into MIRROR. Each different URL is
+    # downloaded once, and unchanged files are not downloaded again.
+    # Returns { url: entry (see _SimMirror.fetch), or None if it failed }
+    if MIRROR is None:
+        raise ValueError("G4L_PHET_MIRROR_PATH is not configured")
+
+    if locales is not None:
+        locales = set([ locale if '_' in locale else locale + '_ALL' for locale in locales ])
+
+    table = _get_locale_table()
+    urls = set()
+    for laboratory_id in (laboratory_ids or table.downloads.keys()):
+        for locale, url in table.downloads.get(laboratory_id, {}).iteritems():
+            if locales is None or locale in locales:
+                url = _mirror_key(url)
+                if url.endswith('.html'):
+                    urls.add(url)
+
+    tasks = [ _MirrorTask(MIRROR, url, force) for url in sorted(urls) ]
+    try:
+        futures = _run_tasks(tasks, threads = threads or MIRROR_THREADS)
+    finally:
+        MIRROR.save_index()
+
+    results = {}
+    for future in futures:
+        if future.exception() is None:
+            results[future.task.url] = future.result()
+        else:
+            results[future.task.url] = None
+    return results
+
+def _build_url_response(localized):
+    url = localized['run_url']
+    return {
+        'reservation_id' : url,
+        'load_url' : url.replace('http://', 'https://')
+    }
+
+def _resolve_localized(entry, locale):
+    # Same fallback as RLMS._get_url: xx_YY -> xx_ALL -> en_ALL
+    localized = entry.get_localized(locale)
+    if localized is None:
+        localized = entry.get_localized(locale.split('_')[0] + '_ALL')
+        if localized is None:
+            localized = entry.get_localized('en_ALL')
+    return localized
+
+class _LocaleFallbackTable(object):
+    # The response of _get_url for every laboratory and requested locale:
+    # {
+    #     laboratory_id: {
+    #         'es_ALL': { 'reservation_id': ..., 'load_url': ... },
+    #     }
+    # }
+    # It is built once per catalog for every language of the catalog. Other
+    # locales (e.g., 'xx_ALL') fall back to one of those responses, and are
+    # not stored: they come from the requests.
+    #
+    # It also keeps the results of get_check_urls and get_downloads:
+    #   check_urls = { laboratory_id: [ load_url1, load_url2 ] } (without duplicates)
+    #   downloads = { laboratory_id: { locale: load_url + '?download' } }
+    def __init__(self, catalog, generation = None):
+        self.catalog = catalog
+        self.version = catalog.version
+        self.generation = generation
+        self.created = time.time()
+        self.responses = {}
+        self.check_urls = {}
+        self.downloads = {}
+
+        responses_by_url = {}
+        languages = catalog.languages
+        for laboratory_id, entry in catalog.iteritems():
+            lab_responses = {}
+            for language in languages:
+                localized = _resolve_localized(entry, language)
+                if localized is not None:
+                    run_url = localized['run_url']
+                    response = responses_by_url.get(run_url)
+                    if response is None:
+                        response = responses_by_url[run_url] = _build_url_response(localized)
+                    lab_responses[language] = response
+            self.responses[laboratory_id] = lab_responses
+
+            check_urls = []
+            downloads = {}
+            download_urls = {}
+            for language in sorted(entry.languages()):
+                load_url = lab_responses[language]['load_url']
+                download_url = download_urls.get(load_url)
+                if download_url is None:
+                    check_urls.append(load_url)
+                    download_url = download_urls[load_url] = load_url + '?download'
+                downloads[language] = download_url
+            self.check_urls[laboratory_id] = check_urls
+            self.downloads[laboratory_id] = downloads
+
+    def expired(self):
+        return time.time() - self.created > MIN_TIME.total_seconds()
+
+    def lookup(self, laboratory_id, locale):
+        lab_responses = self.responses.get(laboratory_id)
+        if lab_responses is None:
+            raise LabNotFoundError("Lab %s not found" % laboratory_id)
+
+        # Same fallback as _resolve_localized: every locale a laboratory has
+        # is a language of the catalog, so it is already in the table
+        response = lab_responses.get(locale)
+        if response is None:
+            response = lab_responses.get(locale.split('_')[0] + '_ALL')
+            if response is None:
+                response = lab_responses.get('en_ALL')
+                if response is None:
+                    raise LabNotFoundError("Lab %s not found in %s" % (laboratory_id, locale))
+
+        # Callers get their own copy
+        return dict(response)
+
+    def cache_items(self, laboratory_ids):
+        # The (cache key, response) pairs RLMS._get_url used to store for each laboratory and language
+        for laboratory_id in laboratory_ids:
+            for language, response in self.responses.get(laboratory_id, {}).iteritems():
+                yield '_'.join((laboratory_id, language)), response
+
+class _LocaleFallbackTableHolder(object):
+    # The _LocaleFallbackTable of this process. While it is being built, other
+    # threads do not wait for it: _get_url uses the <lab>_<locale> entries that
+    # populate_cache stores in the shared cache as a warm start.
+    def __init__(self):
+        self._table = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        # None if there is no table, or if it was built from a catalog which is no longer published
+        table = self._table
+        if table is None or table.expired():
+            return None
+
+        snapshot = CATALOG.current()
+        if snapshot is not None and time.time() - snapshot.checked >= LOCAL_CACHE_MAX_AGE.total_seconds():
+            # Not checked against the cache recently (e.g., another node
+            # published a new catalog and CATALOG.expire() was called)
+            retrieve_all_links()
+            snapshot = CATALOG.current()
+
+        if snapshot is not None and snapshot.generation != table.generation:
+            return None
+        return table
+
+    def building(self):
+        return self._lock.locked()
+
+    def build(self):
+        with self._lock:
+            table = self.get()
+            if table is not None:
+                return table
+
+            retrieve_all_links()
+            snapshot = CATALOG.current()
+            t0 = time.time()
+            table = _LocaleFallbackTable(snapshot.catalog, snapshot.generation)
+            dbg("Locale fallback table built in %.2f seconds" % (time.time() - t0))
+            self._table = table
+            return table
+
+    def reset(self):
+        self._table = None
+
+_LOCALE_TABLE = _LocaleFallbackTableHolder()
+
+def _get_locale_table():
+    return _LOCALE_TABLE.get() or _LOCALE_TABLE.build()
+
+CACHE_BATCH_SIZE = 500
+
+def _cache_write_batch(cache, batch):
+    set_many = getattr(cache, 'set_many', None)
+    if set_many is not None:
+        set_many(batch)
+    else:
+        for key, value in batch.iteritems():
+            cache[key] = value
+
+# Maximum number of batches queued for the _CacheWriter thread
+PENDING_WRITES = int(os.environ.get('G4L_PHET_PENDING_WRITES') or 4)
+
+class _CacheWriter(object):
+    # Writes batches of cache entries from a single background thread, so the
+    # next batch is prepared while the previous one is being written. put()
+    # blocks while there are 'pending' batches queued, so a slow cache does not
+    # pile up copies of the entries (the values themselves, e.g. the responses
+    # of the _LocaleFallbackTable, are still in memory anyway).
+    def __init__(self, pending = None, batch_size = None):
+        self.pending = pending or PENDING_WRITES
+        self.batch_size = batch_size or CACHE_BATCH_SIZE
+        self.written = 0
+        self.failed = 0
+        self._slots = threading.BoundedSemaphore(self.pending)
+        self._queue = Queue.Queue()
+        self._batch = {}
+        self._thread = threading.Thread(target = self._work, name = 'CacheWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, key, value):
+        self._batch[key] = value
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._batch:
+            return
+
+        self._slots.acquire()
+        self._queue.put(self._batch)
+        self._batch = {}
+
+    def close(self):
+        # Waits until everything is written; returns the number of entries written
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        return self.written
+
+    def _work(self):
+        cache = CACHE.shared
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+
+            try:
+                _cache_write_batch(cache, batch)
+                self.written += len(batch)
+            except:
+                self.failed += len(batch)
+                traceback.print_exc()
+            finally:
+                self._slots.release()
+
+# If enabled, populate_cache computes every reserve() response in a single
+# pass over the catalog instead of calling reserve() once per lab and language
+BULK_POPULATE = (os.environ.get('G4L_PHET_BULK_POPULATE') or 'true').lower() == 'true'
+
+POPULATE_INTERVAL_HOURS = 11
+POPULATE_INTERVAL = datetime.timedelta(hours = POPULATE_INTERVAL_HOURS)
+
+# The node running populate_cache holds a lease in the shared cache, renewed
+# every third of this time. If it crashes, another node takes over once it expires.
+POPULATE_LEASE_TTL = datetime.timedelta(seconds = int(os.environ.get('G4L_PHET_LEASE_TTL') or 300))
+
+class _Lease(object):
+    # Lease stored in a shared cache (CACHE.shared by default). The cache has no
+    # atomic operations, so acquire() writes a random token, waits SETTLE_TIME
+    # so concurrent writers overwrite each other, and only the node whose token
+    # is still there wins. While held, a heartbeat thread extends it; if the
+    # token is ever replaced, lost becomes True.
+    SETTLE_TIME = 0.5
+
+    def __init__(self, key, ttl, owner = None, cache = None):
+        self.key = key
+        self.ttl = ttl.total_seconds()
+        self.owner = owner or _process_id()
+        self.token = None
+        self.lost = False
+        self._cache = cache
+        self._stop = threading.Event()
+        self._heartbeat = None
 
+    def __repr__(self):
+        return '_Lease(key=%r, owner=%r, held=%r)' % (self.key, self.owner, self.held())
+
+    @property
+    def cache(self):
+        return CACHE.shared if self._cache is None else self._cache
+
+    def acquire(self):
+        current = self.cache.get(self.key)
+        if current and current['expires'] > time.time():
+            return False
+
+        token = uuid.uuid4().hex
+        now = time.time()
+        self.cache[self.key] = {
+            'owner': self.owner,
+            'token': token,
+            'acquired': now,
+            'heartbeat': now,
+            'expires': now + self.ttl,
+        }
+        time.sleep(self.SETTLE_TIME)
+        current = self.cache.get(self.key)
+        if not current or current['token'] != token:
+            return False
+
+        self.token = token
+        self.lost = False
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target = self._beat, name = 'Lease-%s' % self.key)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+        return True
+
+    def renew(self):
+        current = self.cache.get(self.key)
+        if not current or current['token'] != self.token:
+            return False
+
+        now = time.time()
+        self.cache[self.key] = dict(current, heartbeat = now, expires = now + self.ttl)
+        return True
+
+    def _beat(self):
+        while not self._stop.wait(self.ttl / 3):
+            if not self.renew():
+                dbg("Lease %s lost" % self.key)
+                self.lost = True
+                break
+
+    def held(self):
+        return self.token is not None and not self.lost
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+        if self.token is not None:
+            current = self.cache.get(self.key)
+            if current and current['token'] == self.token:
+                self.cache[self.key] = None
+            self.token = None
+
+@timed('populate_cache')
 def populate_cache():
+    # Run by every node (see add_global_periodic_task below), but only the one
+    # holding the lease does the work; the others pick up the result from the
+    # shared cache. Returns True if this node populated the cache.
+    lease = _Lease('populate_cache_lease', POPULATE_LEASE_TTL)
+    LAST_KEY = 'populate_cache_last'
+
+    last = lease.cache.get(LAST_KEY)
+    if last and time.time() - last['finished'] < POPULATE_INTERVAL.total_seconds() / 2:
+        dbg("Cache populated by %s %.0f seconds ago" % (last['owner'], time.time() - last['finished']))
+        CATALOG.expire()
+        return False
+
+    if not lease.acquire():
+        dbg("Another node is populating the cache")
+        CATALOG.expire()
+        _watch_leader(lease)
+        return False
+
+    try:
+        if BULK_POPULATE:
+            _populate_cache_bulk(lease)
+        else:
+            _populate_cache_tasks(lease)
+
+        if lease.held():
+            lease.cache[LAST_KEY] = { 'owner': lease.owner, 'finished': time.time() }
+    finally:
+        lease.release()
+    return True
+
+_LEADER_WATCHER = None
+_LEADER_WATCHER_LOCK = threading.Lock()
+
+def _watch_leader(lease):
+    # If the leader crashes, its lease expires without populate_cache_last
+    # being updated. Instead of waiting up to POPULATE_INTERVAL for the next
+    # periodic run, followers keep a thread which tries again as soon as the
+    # lease is released or expires (populate_cache returns right away if the
+    # leader finished).
+    global _LEADER_WATCHER
+    with _LEADER_WATCHER_LOCK:
+        if _LEADER_WATCHER is not None and _LEADER_WATCHER.is_alive():
+            return
+        _LEADER_WATCHER = threading.Thread(target = _wait_for_leader, args = (lease,), name = 'LeaderWatcher')
+        _LEADER_WATCHER.daemon = True
+        _LEADER_WATCHER.start()
+
+def _wait_for_leader(lease):
+    try:
+        while True:
+            current = lease.cache.get(lease.key)
+            if current and current['expires'] > time.time():
+                # The heartbeat extends it every third of the TTL
+                time.sleep(current['expires'] - time.time() + lease.SETTLE_TIME)
+                continue
+
+            populate_cache()
+            # Unless another node won the lease in the meanwhile, there is nothing else to wait for
+            current = lease.cache.get(lease.key)
+            if not current or current['expires'] <= time.time():
+                break
+    except:
+        traceback.print_exc()
+
+def _populate_cache_bulk(lease = None):
+    dbg("Retrieving labs")
+    laboratory_ids = [ lab.laboratory_id for lab in retrieve_labs() ]
+
+    try:
+        t0 = time.time()
+        table = _LOCALE_TABLE.build()
+        # Other processes use these entries until they build their own table
+        writer = _CacheWriter()
+        try:
+            for key, response in table.cache_items(laboratory_ids):
+                if lease is not None and lease.lost:
+                    # Another node took over: it will write them
+                    dbg("Lease lost; not storing more responses")
+                    break
+                writer.put(key, response)
+        finally:
+            stored = writer.close()
+        dbg("Finished: %s responses stored (%s failed) in %.2f seconds" % (stored, writer.failed, time.time() - t0))
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+def _populate_cache_tasks(lease = None):
     rlms = RLMS("{}")
     dbg("Retrieving labs")
     LANGUAGES = get_languages()
-    global ALL_LINKS
-    ALL_LINKS = retrieve_all_links()
+    # Built before the tasks start, so they do not wait for it
+    _LOCALE_TABLE.build()
 
     try:
         tasks = []
         for lab in rlms.get_laboratories():
             for lang in LANGUAGES:
-                tasks.append(_QueueTask(lab.laboratory_id, lang))
+                tasks.append(_QueueTask(lab.laboratory_id, lang, lease))
 
         _run_tasks(tasks)
 
         dbg("Finished")
     finally:
-        ALL_LINKS = None
         sys.stdout.flush()
         sys.stderr.flush()
 
 PHET = register("PhET", ['1.0'], __name__)
-PHET.add_global_periodic_task('Populating cache', populate_cache, hours = 11)
+PHET.add_global_periodic_task('Populating cache', populate_cache, hours = POPULATE_INTERVAL_HOURS)
 
 DEBUG = PHET.is_debug() or (os.environ.get('G4L_DEBUG') or '').lower() == 'true' or False
 DEBUG_LOW_LEVEL = DEBUG and (os.environ.get('G4L_DEBUG_LOW') or '').lower() == 'true'
@@ -14,7 +14,11 @@ classifiers=[
 ]
 
 cp_license="MIT"
-install_requires=["beautifulsoup4"]
+install_requires=["requests"]
+extras_require={
+    # Parse the PhET metadata while it is downloaded
+    'streaming': ["ijson"],
+}
 
 setup(name='g4l_rlms_phet',
       version='0.1',
@@ -24,6 +28,7 @@ setup(name='g4l_rlms_phet',
       author_email='pablo.orduna@deusto.es',
       url='http://github.com/gateway4labs/rlms_phet/',
       install_requires=install_requires,
+      extras_require=extras_require,
       license=cp_license,
       py_modules=['g4l_rlms_phet'],
      )